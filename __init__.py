@@ -2,4 +2,7 @@ from .analyse_latents import AnalyzeLatentsInvocation #extra for testing
 from .exposed_denoise_latents import ExposedDenoiseLatentsInvocation
 from .gradient_mask_extensions import GradientMaskExtensionInvocation
 from .fam_extensions import FAM_FM_ExtensionInvocation, FAM_AM_ExtensionInvocation
-from .refDrop_extensions import RefDrop_ExtensionInvocation
\ No newline at end of file
+from .refDrop_extensions import RefDrop_ExtensionInvocation
+from .multidiffusion_extensions import TiledDenoise_ExtensionInvocation
+from .demofusion_extensions import DilatedSampling_ExtensionInvocation, LocalGlobalBlend_ExtensionInvocation, SkipResidual_ExtensionInvocation
+from .demofusion_pipeline import DemoFusionDenoiseLatentsInvocation
@@ -2,53 +2,264 @@ import torch.nn as nn
 import torch
 from invokeai.backend.stable_diffusion.diffusion.custom_atttention import CustomAttnProcessor2_0
 import torch.nn.functional as F
-from torchvision.transforms.functional import resize as tv_resize
 from diffusers.models.attention_processor import Attention, AttnProcessor2_0
 from invokeai.backend.stable_diffusion.diffusion.regional_prompt_data import RegionalPromptData
 from invokeai.backend.stable_diffusion.diffusion.regional_ip_data import RegionalIPData
-from typing import List, Optional, cast
+from typing import List, Literal, Optional, cast
+from dataclasses import dataclass
 import math
+from .attention_ops import quantize_int8
+from .debug_trace import TRACE
+
+ATTENTION_STORAGE_MODES = Literal["dense", "fp16", "int8", "low rank", "top-k"]
+
+
+def linear_resample_weights(in_size: int, out_size: int, device: torch.device) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Source indices and weights of a 1D linear resize (same sample positions as bilinear with align_corners=False).
+    out[o] = in[i0[o]] * (1 - w[o]) + in[i1[o]] * w[o]"""
+    src = (torch.arange(out_size, device=device, dtype=torch.float32) + 0.5) * (in_size / out_size) - 0.5
+    src = src.clamp(min=0)
+    i0 = src.floor().long().clamp(max=in_size - 1)
+    i1 = (i0 + 1).clamp(max=in_size - 1)
+    return i0, i1, src - i0
+
+
+class CompressedAttention:
+    """A stored (batch, heads, Nq, Nk) attention map held in one of ATTENTION_STORAGE_MODES and read back by rows.
+        - dense: as computed
+        - fp16: half precision
+        - int8: per-row symmetric int8
+        - low rank: rank-k factors from a randomized SVD
+        - top-k: the k largest entries of each row, renormalized to sum to 1
+    """
+
+    def __init__(self, attn: torch.Tensor, mode: ATTENTION_STORAGE_MODES = "dense", rank: int = 64, top_k: int = 64):
+        self.shape = attn.shape
+        self.dtype = attn.dtype
+        self.mode = mode
+        if mode == "fp16":
+            self.data = (attn.half(),)
+        elif mode == "int8":
+            self.data = quantize_int8(attn)
+        elif mode == "low rank":
+            rank = min(rank, *attn.shape[-2:])
+            U, S, V = torch.svd_lowrank(attn.float(), q=min(rank + 8, *attn.shape[-2:]), niter=2)
+            self.data = ((U[..., :rank] * S[..., None, :rank]).to(attn.dtype), V[..., :rank].transpose(-2, -1).to(attn.dtype))
+        elif mode == "top-k":
+            values, indices = attn.topk(min(top_k, attn.shape[-1]), dim=-1)
+            values = values / values.sum(dim=-1, keepdim=True).clamp(min=1e-8)
+            index_dtype = torch.int16 if attn.shape[-1] <= torch.iinfo(torch.int16).max else torch.int32
+            self.data = (values, indices.to(index_dtype))
+        else:
+            self.data = (attn,)
+
+    def rows(self, start: int, end: int) -> torch.Tensor:
+        """Dense rows start:end of the map"""
+        if self.mode == "int8":
+            quantized, scale = self.data
+            return (quantized[..., start:end, :].float() * scale[..., start:end, :]).to(self.dtype)
+        if self.mode == "low rank":
+            left, right = self.data
+            return torch.matmul(left[..., start:end, :], right)
+        if self.mode == "top-k":
+            values, indices = self.data
+            block = torch.zeros((*self.shape[:-2], end - start, self.shape[-1]), dtype=self.dtype, device=values.device)
+            return block.scatter_(-1, indices[..., start:end, :].long(), values[..., start:end, :].to(self.dtype))
+        return self.data[0][..., start:end, :].to(self.dtype)
+
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.data)
+
+    def relative_error(self, attn: torch.Tensor, chunk: int = 1024) -> float:
+        """||attn - reconstruction|| / ||attn||, computed chunk rows at a time"""
+        error = 0.0
+        for start in range(0, attn.shape[-2], chunk):
+            end = min(start + chunk, attn.shape[-2])
+            error += (attn[..., start:end, :].float() - self.rows(start, end).float()).pow(2).sum().item()
+        return math.sqrt(error) / max(attn.float().norm().item(), 1e-8)
+
+
+@dataclass
+class ResampleBlock:
+    """Bilinear resize of one block of query rows: which source rows to read and how to mix them"""
+    start: int
+    end: int
+    source_start: int
+    source_end: int
+    i0: Optional[torch.Tensor] # indices into the source rows, None when the row count is unchanged
+    i1: Optional[torch.Tensor]
+    w: Optional[torch.Tensor]
+
+
+@dataclass
+class ResamplePlan:
+    """Precomputed resize of a stored (Nq_s, Nk_s) map to (Nq, Nk), split into query blocks.
+    Source and target shapes are fixed for a layer during a run, so this is built once and reused every step."""
+    key: tuple
+    blocks: list[ResampleBlock]
+    columns: Optional[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] # None when the key count is unchanged
+
+
+def build_resample_plan(
+    source_shape: tuple[int, int],
+    target_shape: tuple[int, int],
+    chunk: int,
+    device: torch.device,
+    dtype: torch.dtype,
+) -> ResamplePlan:
+    source_rows, source_cols = source_shape
+    target_rows, target_cols = target_shape
+    if source_rows != target_rows:
+        i0, i1, w = linear_resample_weights(source_rows, target_rows, device)
+        # only done here, so these reads don't sync the device during the blend
+        i0_host = i0.tolist()
+        i1_host = i1.tolist()
+
+    blocks = []
+    for start in range(0, target_rows, chunk):
+        end = min(start + chunk, target_rows)
+        if source_rows == target_rows:
+            blocks.append(ResampleBlock(start, end, start, end, None, None, None))
+            continue
+        # indices are non-decreasing, so the source rows are one contiguous range
+        low = i0_host[start]
+        high = i1_host[end - 1] + 1
+        blocks.append(ResampleBlock(
+            start, end, low, high,
+            i0[start:end] - low, i1[start:end] - low, w[start:end].to(dtype)[:, None],
+        ))
+
+    columns = None
+    if source_cols != target_cols:
+        j0, j1, v = linear_resample_weights(source_cols, target_cols, device)
+        columns = (j0, j1, v.to(dtype))
+    return ResamplePlan((source_shape, target_shape, chunk, device, dtype), blocks, columns)
+
+
+def resample_block(stored: CompressedAttention, block: ResampleBlock, columns: Optional[tuple]) -> torch.Tensor:
+    """Rows block.start:block.end of the stored map resized to the plan's target shape,
+    without building the rest of the resized map."""
+    source = stored.rows(block.source_start, block.source_end)
+    if block.i0 is None:
+        rows = source
+    else:
+        rows = source[..., block.i0, :] * (1 - block.w) + source[..., block.i1, :] * block.w
+    if columns is None:
+        return rows
+    j0, j1, v = columns
+    return rows[..., j0] * (1 - v) + rows[..., j1] * v
 
 
 class StoreAttentionModulation(CustomAttnProcessor2_0):
     @torch.no_grad()
-    def __init__(self, l: float, *args, **kwargs):
+    def __init__(
+        self,
+        l: float,
+        query_chunk_size: int = 0,
+        storage_mode: ATTENTION_STORAGE_MODES = "dense",
+        storage_rank: int = 64,
+        storage_top_k: int = 64,
+        *args,
+        **kwargs,
+    ):
         self.l = l
         self.store_copy: bool = False
+        self.query_chunk_size = query_chunk_size # 0 = all queries at once
+        self.storage_mode = storage_mode
+        self.storage_rank = storage_rank
+        self.storage_top_k = storage_top_k
+        self.dense_nbytes = 0
+        self.storage_error = 0.0
+        self.resample_plan: Optional[ResamplePlan] = None
+        # multi-level references: the store pass batch holds reference_levels noise levels interleaved as
+        # [uncond level 0..n-1, cond level 0..n-1], and each level is kept as its own map
+        self.reference_levels = 1
+        self.level_copies: list[CompressedAttention] = []
+        self.level_blend: Optional[tuple[int, int, float]] = None
         super().__init__(*args, **kwargs)
+
+    def select_level(self, level: int, next_level: Optional[int] = None, weight: float = 0.0):
+        """Blend with the map of one stored noise level, or lerp between two of them by weight"""
+        self.stored_copy = self.level_copies[level]
+        self.level_blend = (level, next_level, weight) if next_level is not None and next_level != level and weight > 0 else None
+
+    def stored_nbytes(self) -> int:
+        if self.level_copies:
+            return sum(c.nbytes() for c in self.level_copies)
+        return self.stored_copy.nbytes() if getattr(self, "stored_copy", None) is not None else 0
     
+    def get_resample_plan(self, target_shape: tuple[int, int], chunk: int, device: torch.device) -> ResamplePlan:
+        """The resize from the stored map to target_shape, built the first time these shapes are seen"""
+        key = (tuple(self.stored_copy.shape[-2:]), target_shape, chunk, device, self.stored_copy.dtype)
+        if self.resample_plan is None or self.resample_plan.key != key:
+            self.resample_plan = build_resample_plan(*key)
+        return self.resample_plan
+
     @torch.no_grad()
     def new_attention(
         self, query, key, value, is_causal, attn_mask=None, dropout_p=0.0, scale=None
     ):
-        scale = 1 / math.sqrt(math.sqrt(query.size(-1))) if scale is None else scale
-        query *= scale
-        key *= scale
-        attn_weights = torch.matmul(query, key.transpose(-2, -1))
-        if is_causal:
-            assert attn_mask is None
-            temp_mask = (
-                torch.ones((query.shape[-2], key.shape[-2]), device=query.device)
-                .tril_()
-                .bool()
-            )
-            mask = torch.zeros_like(temp_mask, dtype=query.dtype)
-            mask.masked_fill_(temp_mask.logical_not(), float("-inf"))
-            attn_weights.add_(mask)
+        """softmax(QK^T) blended with the stored map, computed over blocks of query rows so that only
+        (heads x chunk x Nk) of attention weights exist at a time. The stored map is resized per block as well."""
+        scale = 1 / math.sqrt(query.size(-1)) if scale is None else scale
+        query_len = query.shape[-2]
+        key_len = key.shape[-2]
+        chunk = self.query_chunk_size if self.query_chunk_size > 0 else query_len
+
+        if self.store_copy:
+            stored_dense = torch.empty((*query.shape[:-1], key_len), dtype=query.dtype, device=query.device)
+        else: #bilinear resize stored copy to same size as attn_weights, then lerp based on self.l
+            plan = self.get_resample_plan((query_len, key_len), chunk, query.device)
+
+        output = torch.empty((*query.shape[:-1], value.shape[-1]), dtype=value.dtype, device=value.device)
+        key_t = key.transpose(-2, -1)
+        for block_index, start in enumerate(range(0, query_len, chunk)):
+            end = min(start + chunk, query_len)
+            attn_weights = torch.matmul(query[..., start:end, :] * scale, key_t)
+            if is_causal:
+                assert attn_mask is None
+                rows = torch.arange(start, end, device=query.device)[:, None]
+                cols = torch.arange(key_len, device=query.device)[None, :]
+                attn_weights.masked_fill_(cols > rows, float("-inf"))
+
+            if attn_mask is not None:
+                attn_weights.add_(attn_mask[..., start:end, :] if attn_mask.shape[-2] > 1 else attn_mask)
+            attn_weights = torch.softmax(attn_weights, dim=-1)
+
+            if self.store_copy:
+                stored_dense[..., start:end, :] = attn_weights
+            elif self.level_blend is not None:
+                level, next_level, weight = self.level_blend
+                stored_block = torch.lerp(
+                    resample_block(self.level_copies[level], plan.blocks[block_index], plan.columns),
+                    resample_block(self.level_copies[next_level], plan.blocks[block_index], plan.columns),
+                    weight,
+                )
+                attn_weights = torch.lerp(attn_weights, stored_block, self.l)
+            else:
+                stored_block = resample_block(self.stored_copy, plan.blocks[block_index], plan.columns)
+                attn_weights = torch.lerp(attn_weights, stored_block, self.l)
 
-        if attn_mask is not None:
-            attn_weights.add_(attn_mask)
-        attn_weights = torch.softmax(attn_weights, dim=-1)
+            attn_weights = torch.dropout(attn_weights, dropout_p, train=True)
+            output[..., start:end, :] = torch.matmul(attn_weights, value)
 
         if self.store_copy:
-            self.stored_copy = attn_weights.clone()
-        else: #tv_resize stored copy to same size as attn_weights using bimodal transform, then lerp based on self.l
-            stored_copy = tv_resize(self.stored_copy, size=attn_weights.shape[-2:], interpolation=2)
-            attn_weights = torch.lerp(attn_weights, stored_copy, self.l)
-        
-        attn_weights = torch.dropout(attn_weights, dropout_p, train=True)
-        print(f"debug: {self.debugname}")
-        return torch.matmul(attn_weights, value)
+            levels = self.reference_levels
+            maps = [stored_dense[k::levels] for k in range(levels)]
+            self.level_copies = [CompressedAttention(m, self.storage_mode, self.storage_rank, self.storage_top_k) for m in maps] if levels > 1 else []
+            self.stored_copy = self.level_copies[0] if levels > 1 else CompressedAttention(stored_dense, self.storage_mode, self.storage_rank, self.storage_top_k)
+            self.level_blend = None
+            self.dense_nbytes = stored_dense.numel() * stored_dense.element_size()
+            if self.storage_mode == "dense":
+                self.storage_error = 0.0
+            elif levels > 1:
+                self.storage_error = sum(c.relative_error(m, chunk) for c, m in zip(self.level_copies, maps)) / levels
+            else:
+                self.storage_error = self.stored_copy.relative_error(stored_dense, chunk)
+            self.resample_plan = None
+        if TRACE.tracing:
+            TRACE.event("FAM_AM", "%s %s query=%d key=%d chunk=%d", self.debugname, "store" if self.store_copy else "blend", query_len, key_len, chunk)
+        return output
 
     @torch.no_grad()
     def __call__(
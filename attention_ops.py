@@ -0,0 +1,54 @@
+# Attention helpers that only need torch, shared by the RefDrop and FAM attention processors
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def quantize_int8(tensor: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric per-token int8 quantization over the head dimension"""
+    scale = tensor.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+    # the scale stays fp32: small-magnitude tokens would underflow it in fp16
+    return torch.round(tensor.float() / scale).to(torch.int8), scale
+
+
+def pool_tokens(tensor: torch.Tensor, latent_size: tuple[int, int], factor: int) -> torch.Tensor:
+    """Average pool a (batch, heads, tokens, head_dim) self-attention tensor over its spatial layout.
+    Tokens are laid out row major at some power of two below the latent size."""
+    b, heads, tokens, head_dim = tensor.shape
+    downscale = round(math.sqrt(latent_size[0] * latent_size[1] / tokens))
+    h = math.ceil(latent_size[0] / downscale)
+    w = math.ceil(latent_size[1] / downscale)
+    if h * w != tokens or h % factor or w % factor:
+        return tensor # layout could not be recovered, store it as is
+    spatial = tensor.permute(0, 1, 3, 2).reshape(b, heads * head_dim, h, w)
+    spatial = F.avg_pool2d(spatial, factor)
+    return spatial.reshape(b, heads, head_dim, -1).permute(0, 1, 3, 2).contiguous()
+
+
+def paired_attention(own: tuple, ref: tuple, stacked: bool = False) -> tuple[torch.Tensor, torch.Tensor]:
+    """Attention for two (query, key, value, mask) sets, returns both outputs.
+    With `stacked`, both go through one scaled_dot_product_attention call over the concatenated batch, which gives
+    the same result as two calls. That needs matching query/key shapes past the batch dimension and compatible masks,
+    otherwise it falls back to two calls.
+    (Concatenating the reference onto the key sequence with a log(C) bias is not equivalent: softmax would weight
+    the two parts by their partition sums, not by C.)"""
+    own_mask, ref_mask = own[3], ref[3]
+    can_stack = (
+        stacked
+        and own[0].shape[1:] == ref[0].shape[1:]
+        and own[1].shape[1:] == ref[1].shape[1:]
+        and (own_mask is None) == (ref_mask is None)
+        and (own_mask is None or own_mask.shape[1:] == ref_mask.shape[1:])
+    )
+    if can_stack:
+        n = own[0].shape[0]
+        query, key, value = (torch.cat([a, b]) for a, b in zip(own[:3], ref[:3]))
+        mask = None if own_mask is None else torch.cat([own_mask, ref_mask])
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=0.0, is_causal=False)
+        return hidden_states[:n], hidden_states[n:]
+
+    return (
+        F.scaled_dot_product_attention(own[0], own[1], own[2], attn_mask=own_mask, dropout_p=0.0, is_causal=False),
+        F.scaled_dot_product_attention(ref[0], ref[1], ref[2], attn_mask=ref_mask, dropout_p=0.0, is_causal=False),
+    )
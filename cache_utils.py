@@ -0,0 +1,230 @@
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Union
+
+import torch
+from invokeai.app.invocations.denoise_latents import DenoiseLatentsInvocation
+from invokeai.app.invocations.fields import ConditioningField
+from invokeai.app.services.shared.invocation_context import InvocationContext
+from invokeai.backend.stable_diffusion.diffusion.conditioning_data import TextConditioningData
+from invokeai.backend.util.logging import info, warning, error
+
+
+def tensor_nbytes(value: Any) -> int:
+    """Total bytes of all tensors inside a (possibly nested) dict/list/tuple"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+def hash_tensors(*tensors: torch.Tensor) -> str:
+    """Content hash of some tensors over their raw bytes, so any change to any element changes the hash.
+    Copies each tensor to the CPU, so keep it to things that are hashed once per run."""
+    h = hashlib.sha1()
+    for t in tensors:
+        h.update(str((tuple(t.shape), t.dtype)).encode())
+        h.update(t.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class TensorLRUCache:
+    """Process-wide LRU cache of tensors (or nested containers of tensors), bounded by bytes instead of entries.
+    If spill_to_disk is set, evicted entries are written to a temp directory and promoted back on the next hit.
+    """
+
+    def __init__(self, max_bytes: int, spill_to_disk: bool = False):
+        self.max_bytes = max_bytes
+        self.spill_to_disk = spill_to_disk
+        self.current_bytes = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._spilled: dict[Hashable, str] = {}
+        self._spill_dir: Optional[str] = None
+
+    def configure(self, max_bytes: int, spill_to_disk: bool = False):
+        self.max_bytes = max_bytes
+        self.spill_to_disk = spill_to_disk
+        self._evict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries or key in self._spilled
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        if key in self._spilled:
+            path = self._spilled.pop(key)
+            try:
+                value = torch.load(path, map_location="cpu")
+            except Exception as e:
+                warning(f"Could not read spilled cache entry {path}: {e}")
+                return None
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.put(key, value)
+            return value
+        return None
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None):
+        size = tensor_nbytes(value) if size is None else size
+        if size > self.max_bytes:
+            return # would evict everything else and still not fit
+        self.pop(key)
+        self._entries[key] = (value, size)
+        self.current_bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable):
+        if key in self._entries:
+            _, size = self._entries.pop(key)
+            self.current_bytes -= size
+        path = self._spilled.pop(key, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+        self._spilled.clear()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            key, (value, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            if self.spill_to_disk:
+                self._spill(key, value)
+
+    def _spill(self, key: Hashable, value: Any):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="demofusion_cache_")
+            atexit.register(shutil.rmtree, self._spill_dir, True)
+        path = os.path.join(self._spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".pt")
+        try:
+            torch.save(value, path)
+            self._spilled[key] = path
+        except Exception as e:
+            warning(f"Could not spill cache entry to {path}: {e}")
+
+
+class LoadedTensorCache:
+    """Tensors from context.tensors.load, shared by every extension and kept between invocations.
+    Saved tensor names are unique and their content never changes, so the name is the key. Device/dtype converted
+    variants are kept next to the loaded tensor, so repeated runs skip both the disk read and the host to device copy.
+    Returned tensors are shared: do not modify them in place."""
+
+    def __init__(self, max_bytes: int):
+        self.entries = TensorLRUCache(max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def load(
+        self,
+        context: InvocationContext,
+        name: str,
+        device: Optional[Union[torch.device, str]] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+        key = (name, None if device is None else str(torch.device(device)), dtype)
+        tensor = self.entries.get(key)
+        if tensor is not None:
+            self.hits += 1
+            return tensor
+        self.misses += 1
+
+        loaded = self.entries.get((name, None, None))
+        if loaded is None:
+            loaded = context.tensors.load(name)
+            self.entries.put((name, None, None), loaded)
+        if device is None and dtype is None:
+            return loaded
+        tensor = loaded.to(device=device, dtype=dtype)
+        self.entries.put(key, tensor)
+        return tensor
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.entries.current_bytes}
+
+
+LOADED_TENSORS = LoadedTensorCache(max_bytes=512 * 2**20)
+
+
+def cached_tensor(
+    context: InvocationContext,
+    name: str,
+    device: Optional[Union[torch.device, str]] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> torch.Tensor:
+    """context.tensors.load through the shared LOADED_TENSORS cache, optionally converted to device/dtype"""
+    return LOADED_TENSORS.load(context, name, device, dtype)
+
+
+# built conditioning shared by the denoise node and any extension that needs its own conditioning.
+# Lives on the denoise device, so keep it small.
+CONDITIONING_CACHE = TensorLRUCache(max_bytes=256 * 2**20)
+
+
+def _conditioning_field_key(field: Union[ConditioningField, list[ConditioningField], None]) -> Hashable:
+    if isinstance(field, list):
+        return tuple(repr(f) for f in field)
+    return repr(field)
+
+
+def conditioning_nbytes(conditioning: TextConditioningData) -> int:
+    parts = [conditioning.uncond_text, conditioning.cond_text, conditioning.uncond_regions, conditioning.cond_regions]
+    return sum(tensor_nbytes(vars(p)) for p in parts if p is not None)
+
+
+def cached_conditioning_data(
+    context: InvocationContext,
+    positive_conditioning_field: Union[ConditioningField, list[ConditioningField]],
+    negative_conditioning_field: Union[ConditioningField, list[ConditioningField]],
+    cfg_scale: float | list[float],
+    steps: int,
+    latent_height: int,
+    latent_width: int,
+    device: torch.device,
+    dtype: torch.dtype,
+    cfg_rescale_multiplier: float,
+) -> TextConditioningData:
+    """DenoiseLatentsInvocation.get_conditioning_data, but repeated requests for the same conditioning names,
+    latent size, dtype and device skip loading and concatenating the conditioning tensors.
+    The returned object is shared, do not modify it."""
+    key = (
+        _conditioning_field_key(positive_conditioning_field),
+        _conditioning_field_key(negative_conditioning_field),
+        tuple(cfg_scale) if isinstance(cfg_scale, list) else cfg_scale,
+        steps,
+        latent_height,
+        latent_width,
+        str(device),
+        str(dtype),
+        cfg_rescale_multiplier,
+    )
+    conditioning = CONDITIONING_CACHE.get(key)
+    if conditioning is None:
+        conditioning = DenoiseLatentsInvocation.get_conditioning_data(
+            context=context,
+            positive_conditioning_field=positive_conditioning_field,
+            negative_conditioning_field=negative_conditioning_field,
+            cfg_scale=cfg_scale,
+            steps=steps,
+            latent_height=latent_height,
+            latent_width=latent_width,
+            device=device,
+            dtype=dtype,
+            cfg_rescale_multiplier=cfg_rescale_multiplier,
+        )
+        CONDITIONING_CACHE.put(key, conditioning, size=conditioning_nbytes(conditioning))
+    return conditioning
@@ -0,0 +1,82 @@
+import os
+import time
+from collections import Counter, deque
+from typing import Literal, Optional
+
+from invokeai.backend.util.logging import info, warning, error
+
+TRACE_LEVELS = Literal["off", "debug", "trace"]
+_LEVEL_VALUES = {"off": 0, "debug": 1, "trace": 2}
+
+
+class DebugTrace:
+    """Level-gated debug channel shared by the extensions.
+        - off: nothing is formatted or recorded
+        - debug: per-run messages (setup, reference passes, cache hits) go to the InvokeAI log
+        - trace: additionally records per-layer events (every custom attention call) into a ring buffer,
+          which is flushed once after the denoise loop instead of writing to the log from the UNet forward
+
+    Set the level with the DEMOFUSION_DEBUG environment variable. DEMOFUSION_TRACE_FILE makes flush() write the
+    buffered events to that file, otherwise only a per-source count is logged.
+    Hot paths should check `TRACE.tracing` before building a message so that the off state costs one attribute read.
+    """
+
+    def __init__(self, level: TRACE_LEVELS = "off", buffer_size: int = 4096, trace_file: Optional[str] = None):
+        self.events: deque[tuple[float, str, str, tuple]] = deque(maxlen=buffer_size)
+        self.trace_file = trace_file
+        self.configure(level)
+
+    @classmethod
+    def from_env(cls) -> "DebugTrace":
+        level = os.environ.get("DEMOFUSION_DEBUG", "off").lower()
+        if level not in _LEVEL_VALUES:
+            warning(f"Unknown DEMOFUSION_DEBUG level '{level}', expected one of {list(_LEVEL_VALUES)}")
+            level = "off"
+        return cls(level, int(os.environ.get("DEMOFUSION_TRACE_BUFFER", 4096)), os.environ.get("DEMOFUSION_TRACE_FILE"))
+
+    def configure(self, level: TRACE_LEVELS, buffer_size: Optional[int] = None):
+        self.level = level
+        self.debugging = _LEVEL_VALUES[level] >= _LEVEL_VALUES["debug"]
+        self.tracing = _LEVEL_VALUES[level] >= _LEVEL_VALUES["trace"]
+        if buffer_size is not None and buffer_size != self.events.maxlen:
+            self.events = deque(self.events, maxlen=buffer_size)
+
+    def debug(self, source: str, message: str, *args):
+        """Log a per-run message. %-style args are only formatted when debugging is on."""
+        if self.debugging:
+            info(f"[{source}] " + (message % args if args else message))
+
+    def event(self, source: str, message: str, *args):
+        """Record a per-layer event in the ring buffer. %-style args are only formatted when the buffer is dumped."""
+        if self.tracing:
+            self.events.append((time.perf_counter(), source, message, args))
+
+    def dump(self) -> list[str]:
+        """Buffered events as lines, oldest first, with times relative to the first event"""
+        if not self.events:
+            return []
+        start = self.events[0][0]
+        return [
+            f"{(t - start) * 1000:10.3f}ms [{source}] " + (message % args if args else message)
+            for t, source, message, args in self.events
+        ]
+
+    def flush(self):
+        """Write out and clear the buffered events. Called by the extensions at the end of the denoise loop."""
+        if not self.events:
+            return
+        counts = Counter(source for _, source, _, _ in self.events)
+        summary = ", ".join(f"{source}: {count}" for source, count in counts.items())
+        if self.trace_file:
+            try:
+                with open(self.trace_file, "a") as f:
+                    f.write("\n".join(self.dump()) + "\n")
+                info(f"Wrote {len(self.events)} trace events ({summary}) to {self.trace_file}")
+            except OSError as e:
+                error(f"Could not write trace events to {self.trace_file}: {e}")
+        else:
+            info(f"Recorded {len(self.events)} trace events ({summary}); set DEMOFUSION_TRACE_FILE to keep them")
+        self.events.clear()
+
+
+TRACE = DebugTrace.from_env()
@@ -0,0 +1,458 @@
+####################################################################################################
+# DemoFusion
+# From: https://ruoyidu.github.io/demofusion/demofusion.html
+####################################################################################################
+import math
+from typing import Any, Callable, Optional
+
+import torch
+import torch.nn.functional as F
+from invokeai.app.invocations.baseinvocation import BaseInvocation, invocation
+from invokeai.app.invocations.fields import InputField, LatentsField
+from invokeai.app.services.shared.invocation_context import InvocationContext
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext
+from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
+from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase, callback
+from invokeai.backend.util.logging import info, warning, error
+
+from .cache_utils import cached_tensor
+from .debug_trace import TRACE
+from .extension_classes import GuidanceDataOutput, GuidanceField, add_noise_coefficients, base_guidance_extension, wrap_unet_forward
+from .fam_extensions import reference_noise
+from .latent_filters import gaussian_blur
+from .multidiffusion_extensions import TILE_BLEND_MODES, get_views, repeat_batch_kwargs, tiled_unet_forward
+
+
+RESIDUAL_NAMES = ("down_block_additional_residuals", "mid_block_additional_residual", "down_intrablock_additional_residuals")
+
+
+def cosine_factor(timestep: float, num_train_timesteps: int) -> float:
+    """1 at the start of the denoise (t = T), falling to 0 at the end"""
+    return 0.5 * (1 + math.cos(math.pi * (num_train_timesteps - timestep) / num_train_timesteps))
+
+
+def dilate(sample: torch.Tensor, dilation_scale: int, sigma: float) -> torch.Tensor:
+    """Blur the latent and split it into the s*s interlaced subsamples [i::s, j::s], stacked (s*s*B, C, h, w)
+    subsample major, the layout repeat_batch_kwargs expects."""
+    s = dilation_scale
+    batch, channels, height, width = sample.shape
+    std_, mean_ = sample.std(), sample.mean()
+    blurred = gaussian_blur(sample, kernel_size=2 * s - 1, sigma=sigma)
+    blurred = (blurred - blurred.mean()) / blurred.std() * std_ + mean_
+
+    # pad to a multiple of s so every subsample has the same size and they stack
+    pad_h = -height % s
+    pad_w = -width % s
+    if pad_h or pad_w:
+        blurred = F.pad(blurred, (0, pad_w, 0, pad_h), mode="replicate")
+    h, w = blurred.shape[-2] // s, blurred.shape[-1] // s
+
+    # (B, C, h*s, w*s) -> (s*s*B, C, h, w), subsample (i, j) = blurred[..., i::s, j::s]
+    return blurred.view(batch, channels, h, s, w, s).permute(3, 5, 0, 1, 2, 4).reshape(s * s * batch, channels, h, w)
+
+
+def undilate(noise_pred: torch.Tensor, dilation_scale: int, height: int, width: int) -> torch.Tensor:
+    """Interlace the predictions for the subsamples from `dilate` back into one (B, C, height, width) prediction"""
+    s = dilation_scale
+    _, out_channels, h, w = noise_pred.shape
+    batch = noise_pred.shape[0] // (s * s)
+    noise_pred = noise_pred.view(s, s, batch, out_channels, h, w).permute(2, 3, 4, 0, 5, 1).reshape(batch, out_channels, h * s, w * s)
+    return noise_pred[:, :, :height, :width]
+
+
+def dilated_unet_forward(
+    default: Callable[..., torch.Tensor],
+    sample: torch.Tensor,
+    dilation_scale: int,
+    sigma: float,
+    **kwargs,
+) -> torch.Tensor:
+    """DemoFusion dilated sampling: blur the latent, split it into the s*s interlaced subsamples [h::s, w::s],
+    predict noise for all of them in one batched UNet call, and interlace the predictions back together.
+    ControlNet/T2I residuals don't line up with interlaced subsamples, so they are not applied here."""
+    s = dilation_scale
+    if s <= 1:
+        return default(sample=sample, **kwargs)
+
+    stacked = repeat_batch_kwargs(kwargs, s * s)
+    for name in RESIDUAL_NAMES:
+        stacked[name] = None
+    noise_pred = default(sample=dilate(sample, s, sigma), **stacked)
+    return undilate(noise_pred, s, sample.shape[-2], sample.shape[-1])
+
+
+@base_guidance_extension("DilatedSampling")
+class DilatedSamplingGuidance(ExtensionBase):
+    """
+    Replaces each UNet call with DemoFusion's dilated sampling, which gives the UNet a global view of a latent larger
+    than it was trained on. All s*s interlaced subsamples share one UNet forward.
+    """
+    def __init__(
+        self,
+        context: InvocationContext,
+        dilation_scale: int,
+        gaussian_decay_rate: float,
+    ):
+        self.dilation_scale = dilation_scale
+        self.gaussian_decay_rate = gaussian_decay_rate
+        self.num_train_timesteps = 1000
+        self.restore_unet_forward: Optional[Callable[[], None]] = None
+        super().__init__()
+
+    @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
+    def pre_denoise_loop(self, ctx: DenoiseContext):
+        conditioning = ctx.inputs.conditioning_data
+        if conditioning.cond_regions is not None or conditioning.uncond_regions is not None:
+            raise ValueError("Dilated sampling does not support regional prompts")
+        self.num_train_timesteps = ctx.scheduler.config.num_train_timesteps
+        self.restore_unet_forward = wrap_unet_forward(ctx.sd_backend, self.unet_forward)
+
+    def sigma(self, timestep: torch.Tensor) -> float:
+        """Blur strength, decaying with the cosine schedule so late steps are barely blurred"""
+        t = timestep.flatten()[0].item()
+        return cosine_factor(t, self.num_train_timesteps) ** self.gaussian_decay_rate + 1e-2
+
+    def unet_forward(self, default, sample: torch.Tensor, timestep: torch.Tensor, **kwargs) -> torch.Tensor:
+        if TRACE.tracing:
+            TRACE.event("DilatedSampling", "%dx%d subsamples of %s", self.dilation_scale, self.dilation_scale, tuple(sample.shape))
+        return dilated_unet_forward(default, sample, self.dilation_scale, self.sigma(timestep), timestep=timestep, **kwargs)
+
+    @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
+    def post_denoise_loop(self, ctx: DenoiseContext):
+        if self.restore_unet_forward is not None:
+            self.restore_unet_forward()
+            self.restore_unet_forward = None
+
+
+@invocation(
+    "dilated_sampling_extInvocation",
+    title="DemoFusion Dilated Sampling [Extension]",
+    tags=["demofusion", "dilated", "denoise", "extension"],
+    category="latents",
+    version="1.0.0",
+)
+class DilatedSampling_ExtensionInvocation(BaseInvocation):
+    """Global-coherence sampling for large latents: denoises interlaced subsamples of the latent in one batch."""
+    dilation_scale: int = InputField(
+        title="Dilation Factor",
+        description="The dilation scale to use when creating interlaced latents (e.g. '2' will split every 2x2 square among 4 latents)",
+        ge=1,
+        default=2,
+    )
+    gaussian_decay_rate: float = InputField(
+        title="Gaussian Decay Rate",
+        description="The decay rate to use when blurring the combined latents. Higher values will result in less blurring in later timesteps.",
+        ge=0,
+        default=1,
+    )
+
+    def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
+        kwargs = {
+            "dilation_scale": self.dilation_scale,
+            "gaussian_decay_rate": self.gaussian_decay_rate,
+        }
+        return GuidanceDataOutput(
+            guidance_data_output=GuidanceField(
+                guidance_name="DilatedSampling",
+                extension_kwargs=kwargs
+            )
+        )
+
+
+@base_guidance_extension("LocalGlobalBlend")
+class LocalGlobalBlendGuidance(ExtensionBase):
+    """
+    DemoFusion's blend of a local (tiled) and a global (dilated) noise prediction: global early in the denoise, local
+    late, weighted c2 = 1 - cosine_factor**decay_rate. A branch whose weight is within skip_threshold of 0 is not
+    computed at all. When both are needed and the tiles are the size of the subsamples, the subsamples ride along with
+    the first batch of tiles in the same UNet call.
+    """
+    def __init__(
+        self,
+        context: InvocationContext,
+        tile_size: int,
+        stride: int,
+        dilation_scale: int,
+        tile_batch_size: int = 1,
+        blend: TILE_BLEND_MODES = "gaussian",
+        decay_rate: float = 1.0,
+        gaussian_decay_rate: float = 1.0,
+        skip_threshold: float = 0.01,
+    ):
+        self.window_size = tile_size // 8
+        self.stride = stride // 8
+        self.dilation_scale = dilation_scale
+        self.tile_batch_size = tile_batch_size
+        self.blend = blend
+        self.decay_rate = decay_rate
+        self.gaussian_decay_rate = gaussian_decay_rate
+        self.skip_threshold = skip_threshold
+        self.num_train_timesteps = 1000
+        self.restore_unet_forward: Optional[Callable[[], None]] = None
+        super().__init__()
+
+    @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
+    def pre_denoise_loop(self, ctx: DenoiseContext):
+        conditioning = ctx.inputs.conditioning_data
+        if conditioning.cond_regions is not None or conditioning.uncond_regions is not None:
+            raise ValueError("Local/global blending does not support regional prompts")
+        self.num_train_timesteps = ctx.scheduler.config.num_train_timesteps
+        self.restore_unet_forward = wrap_unet_forward(ctx.sd_backend, self.unet_forward)
+
+    def unet_forward(self, default, sample: torch.Tensor, timestep: torch.Tensor, **kwargs) -> torch.Tensor:
+        factor = cosine_factor(timestep.flatten()[0].item(), self.num_train_timesteps)
+        c2 = 1 - factor ** self.decay_rate
+        sigma = factor ** self.gaussian_decay_rate + 1e-2
+        kwargs["timestep"] = timestep
+
+        if c2 <= self.skip_threshold:
+            TRACE.debug("LocalGlobalBlend", "c2 %.4f, global only", c2)
+            return dilated_unet_forward(default, sample, self.dilation_scale, sigma, **kwargs)
+        views = get_views(sample.shape[-2], sample.shape[-1], self.window_size, self.stride)
+        if c2 >= 1 - self.skip_threshold:
+            TRACE.debug("LocalGlobalBlend", "c2 %.4f, local only", c2)
+            return tiled_unet_forward(default, sample, views, self.tile_batch_size, self.blend, **kwargs)
+
+        local_pred, global_pred = self.local_and_global(default, sample, views, sigma, **kwargs)
+        return torch.lerp(global_pred, local_pred, c2)
+
+    def local_and_global(self, default, sample: torch.Tensor, views: list, sigma: float, **kwargs) -> tuple[torch.Tensor, torch.Tensor]:
+        s = self.dilation_scale
+        batch, _, height, width = sample.shape
+        h0, h1, w0, w1 = views[0]
+        subsamples = dilate(sample, s, sigma) if s > 1 else sample
+        has_residuals = any(kwargs.get(name) is not None for name in RESIDUAL_NAMES)
+        if has_residuals or subsamples.shape[-2:] != (h1 - h0, w1 - w0):
+            # tile residuals are sliced per tile and the subsamples get none, so they can't share a call
+            local_pred = tiled_unet_forward(default, sample, views, self.tile_batch_size, self.blend, **kwargs)
+            global_pred = dilated_unet_forward(default, sample, s, sigma, **kwargs)
+            return local_pred, global_pred
+
+        subsample_pred: list[torch.Tensor] = []
+        def first_batch_with_subsamples(sample: torch.Tensor, **tile_kwargs) -> torch.Tensor:
+            if subsample_pred:
+                return default(sample=sample, **tile_kwargs)
+            # without residuals the tile kwargs are plain repeats, so repeat once for tiles and subsamples together
+            n = sample.shape[0]
+            merged = default(sample=torch.cat([sample, subsamples]), **repeat_batch_kwargs(kwargs, (n + subsamples.shape[0]) // batch))
+            subsample_pred.append(merged[n:])
+            return merged[:n]
+
+        local_pred = tiled_unet_forward(first_batch_with_subsamples, sample, views, self.tile_batch_size, self.blend, **kwargs)
+        global_pred = undilate(subsample_pred[0], s, height, width) if s > 1 else subsample_pred[0]
+        if TRACE.tracing:
+            TRACE.event("LocalGlobalBlend", "%d subsamples batched with the first %d tiles", subsamples.shape[0] // batch, min(self.tile_batch_size, len(views)))
+        return local_pred, global_pred
+
+    @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
+    def post_denoise_loop(self, ctx: DenoiseContext):
+        if self.restore_unet_forward is not None:
+            self.restore_unet_forward()
+            self.restore_unet_forward = None
+
+
+@invocation(
+    "local_global_blend_extInvocation",
+    title="DemoFusion Local/Global Blend [Extension]",
+    tags=["demofusion", "multidiffusion", "tiled", "dilated", "denoise", "extension"],
+    category="latents",
+    version="1.0.0",
+)
+class LocalGlobalBlend_ExtensionInvocation(BaseInvocation):
+    """Blends tiled (local detail) and dilated (global structure) sampling along a cosine schedule."""
+    tile_size: int = InputField(
+        title="Tile Size",
+        description="Size of each local tile in pixels. Tiles the size of the dilated subsamples (resolution / dilation factor) are batched together with them.",
+        default=1024,
+        ge=128,
+        multiple_of=64,
+    )
+    stride: int = InputField(
+        title="Stride",
+        description="Distance from the start of each tile to the next in pixels.",
+        default=512,
+        ge=64,
+        multiple_of=64,
+    )
+    tile_batch_size: int = InputField(
+        title="Tile Batch Size",
+        description="How many tiles go through the UNet in one call. Higher is faster until memory runs out.",
+        default=1,
+        ge=1,
+    )
+    blend: TILE_BLEND_MODES = InputField(
+        title="Blend",
+        description="How overlapping tiles are combined. Gaussian fades each tile out toward its edges, uniform averages them.",
+        default="gaussian",
+    )
+    dilation_scale: int = InputField(
+        title="Dilation Factor",
+        description="The dilation scale to use when creating interlaced latents (e.g. '2' will split every 2x2 square among 4 latents)",
+        ge=1,
+        default=2,
+    )
+    decay_rate: float = InputField(
+        title="Decay Rate",
+        description="How quickly the prediction moves from global to local. Higher values move sooner.",
+        ge=0,
+        default=1,
+    )
+    gaussian_decay_rate: float = InputField(
+        title="Gaussian Decay Rate",
+        description="The decay rate to use when blurring the combined latents. Higher values will result in less blurring in later timesteps.",
+        ge=0,
+        default=1,
+    )
+    skip_threshold: float = InputField(
+        title="Skip Threshold",
+        description="A branch whose blend weight is below this is not computed, saving a full UNet pass on those steps. 0 always computes both.",
+        ge=0,
+        le=0.5,
+        default=0.01,
+    )
+
+    def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
+        kwargs = {
+            "tile_size": self.tile_size,
+            "stride": self.stride,
+            "tile_batch_size": self.tile_batch_size,
+            "blend": self.blend,
+            "dilation_scale": self.dilation_scale,
+            "decay_rate": self.decay_rate,
+            "gaussian_decay_rate": self.gaussian_decay_rate,
+            "skip_threshold": self.skip_threshold,
+        }
+        return GuidanceDataOutput(
+            guidance_data_output=GuidanceField(
+                guidance_name="LocalGlobalBlend",
+                extension_kwargs=kwargs
+            )
+        )
+
+
+@base_guidance_extension("SkipResidual")
+class SkipResidualGuidance(ExtensionBase):
+    """
+    DemoFusion's skip residual: before every step the latents are pulled toward a reference latent noised to the
+    current timestep, with a weight that decays from 1 to 0 along the cosine schedule.
+    The noised reference for every timestep is built in one vectorized op before the loop, so each step is a lookup
+    and an in-place lerp.
+    """
+    def __init__(
+        self,
+        context: InvocationContext,
+        decay_rate: float = 3.0,
+        latent_image_name: Optional[str] = None,
+        seed: Optional[int] = None,
+        offload_to_cpu: bool = False,
+        reference: Optional[torch.Tensor] = None,
+    ):
+        if reference is None and latent_image_name is None:
+            raise ValueError("Skip residual needs a reference latent")
+        self.context = context
+        self.decay_rate = decay_rate
+        self.latent_image_name = latent_image_name
+        self.seed = seed
+        self.offload_to_cpu = offload_to_cpu
+        self.reference = reference
+        self.noised_references: Optional[torch.Tensor] = None # (steps, B, C, H, W)
+        self.weights: list[float] = []
+        self.buffers: list[torch.Tensor] = [] # device copies of the next rows when offloaded
+        super().__init__()
+
+    @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
+    @torch.no_grad()
+    def pre_denoise_loop(self, ctx: DenoiseContext):
+        device, dtype = ctx.latents.device, ctx.latents.dtype
+        if self.reference is not None:
+            reference = self.reference.to(device=device, dtype=dtype)
+        else:
+            reference = cached_tensor(self.context, self.latent_image_name, device, dtype)
+        if reference.shape[-2:] != ctx.latents.shape[-2:]:
+            reference = F.interpolate(reference.float(), size=ctx.latents.shape[-2:], mode="bicubic", align_corners=False).to(dtype)
+        noise = reference_noise(ctx, reference.shape, self.seed)
+
+        timesteps = ctx.inputs.timesteps
+        latent_coefficients, noise_coefficients = add_noise_coefficients(ctx.scheduler, timesteps, device)
+        shape = (-1,) + (1,) * reference.dim()
+        self.noised_references = torch.addcmul(
+            noise_coefficients.to(dtype).view(shape) * noise,
+            latent_coefficients.to(dtype).view(shape),
+            reference,
+        )
+        num_train_timesteps = ctx.scheduler.config.num_train_timesteps
+        self.weights = [cosine_factor(t, num_train_timesteps) ** self.decay_rate for t in timesteps.tolist()]
+
+        if self.offload_to_cpu and device.type == "cuda":
+            self.noised_references = self.noised_references.cpu().pin_memory()
+            self.buffers = [torch.empty_like(reference) for _ in range(2)]
+            self.buffers[0].copy_(self.noised_references[0], non_blocking=True)
+        TRACE.debug("SkipResidual", "%d noised references of %s, offloaded: %s", len(self.weights), tuple(reference.shape), bool(self.buffers))
+
+    def noised_reference(self, i: int) -> torch.Tensor:
+        if not self.buffers:
+            return self.noised_references[i]
+        # streamed: row i was copied last step, start copying row i + 1 behind it
+        row = self.buffers[i % 2]
+        if i + 1 < len(self.weights):
+            self.buffers[(i + 1) % 2].copy_(self.noised_references[i + 1], non_blocking=True)
+        return row
+
+    @callback(ExtensionCallbackType.PRE_STEP)
+    @torch.no_grad()
+    def pre_step(self, ctx: DenoiseContext):
+        i = ctx.step_index
+        row = self.noised_reference(i)
+        if self.weights[i] > 0:
+            ctx.latents.lerp_(row, self.weights[i])
+
+    @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
+    def post_denoise_loop(self, ctx: DenoiseContext):
+        self.noised_references = None
+        self.buffers = []
+
+
+@invocation(
+    "skip_residual_extInvocation",
+    title="DemoFusion Skip Residual [Extension]",
+    tags=["demofusion", "skip residual", "denoise", "extension"],
+    category="latents",
+    version="1.0.0",
+)
+class SkipResidual_ExtensionInvocation(BaseInvocation):
+    """Keeps the early steps of a denoise close to a reference latent, e.g. an upscaled lower resolution result."""
+    latent_image: LatentsField = InputField(
+        title="Latent Image",
+        description="Reference latents. Resized (bicubic) to the denoise size if they differ.",
+    )
+    decay_rate: float = InputField(
+        title="Decay Rate",
+        description="How quickly the denoise lets go of the reference. Higher values let go sooner.",
+        default=3.0,
+        ge=0,
+    )
+    seed: Optional[int] = InputField(
+        title="Seed",
+        description="Seed for the noise added to the reference. Leave empty to follow the denoise seed (and reuse its noise when the sizes match).",
+        default=None,
+        ge=0,
+    )
+    offload_to_cpu: bool = InputField(
+        title="Offload To CPU",
+        description="Keep the noised references in CPU memory and copy one step ahead to the GPU. Saves VRAM for long, large denoises.",
+        default=False,
+    )
+
+    def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
+        kwargs = {
+            "latent_image_name": self.latent_image.latents_name,
+            "decay_rate": self.decay_rate,
+            "seed": self.seed,
+            "offload_to_cpu": self.offload_to_cpu,
+        }
+        return GuidanceDataOutput(
+            guidance_data_output=GuidanceField(
+                guidance_name="SkipResidual",
+                extension_kwargs=kwargs
+            )
+        )
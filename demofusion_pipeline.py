@@ -0,0 +1,192 @@
+####################################################################################################
+# DemoFusion progressive upscaling
+# From: https://ruoyidu.github.io/demofusion/demofusion.html
+####################################################################################################
+import torch
+import torch.nn.functional as F
+from invokeai.app.invocations.noise import get_noise
+from invokeai.invocation_api import (
+    invocation,
+    InputField,
+    InvocationContext,
+    LatentsOutput,
+)
+from invokeai.backend.model_manager import ModelVariantType
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext, DenoiseInputs
+from invokeai.backend.stable_diffusion.diffusion_backend import StableDiffusionBackend
+from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
+from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase
+from invokeai.backend.stable_diffusion.extensions.inpaint import InpaintExt
+from invokeai.backend.stable_diffusion.extensions.inpaint_model import InpaintModelExt
+from invokeai.backend.stable_diffusion.extensions_manager import ExtensionsManager
+from invokeai.backend.util.logging import info, warning, error
+
+from .debug_trace import TRACE
+from .demofusion_extensions import DilatedSamplingGuidance, LocalGlobalBlendGuidance, SkipResidualGuidance
+from .exposed_denoise_latents import ExposedDenoiseLatentsInvocation
+from .multidiffusion_extensions import TiledDenoiseGuidance
+
+# Not carried into the upscaling phases: the inpaint mask is sized to the base latents, and the phases bring their own
+# tiling, dilated sampling and skip residual, which would nest with a second copy wrapping the same UNet forward.
+BASE_ONLY_EXTENSIONS = (
+    InpaintExt,
+    InpaintModelExt,
+    TiledDenoiseGuidance,
+    DilatedSamplingGuidance,
+    LocalGlobalBlendGuidance,
+    SkipResidualGuidance,
+)
+
+
+@invocation(
+    "demofusion_denoise_latents",
+    title="DemoFusion Denoise Latents",
+    tags=["latents", "denoise", "demofusion", "upscale", "txt2img", "t2i", "t2l", "img2img", "i2i", "l2l"],
+    category="latents",
+    version="1.1.0",
+)
+class DemoFusionDenoiseLatentsInvocation(ExposedDenoiseLatentsInvocation):
+    """Exposed Denoise Latents followed by DemoFusion's progressive upscaling: each phase upsamples the result,
+    re-noises it and denoises it again with local tiles and dilated global sampling. All phases share one model load."""
+
+    scale_factor: int = InputField(
+        title="Scale Factor",
+        description="Final size as a multiple of the input latents. Each whole step up to it is one more denoise (x2, x3, ...).",
+        default=2,
+        ge=2,
+        le=8,
+        ui_order=11,
+    )
+    stride: int = InputField(
+        title="Tile Stride",
+        description="Distance between local tiles in pixels. Tiles are the size of the input latents (the shorter side, for non-square inputs).",
+        default=512,
+        ge=64,
+        multiple_of=64,
+        ui_order=12,
+    )
+    tile_batch_size: int = InputField(
+        title="Tile Batch Size",
+        description="How many local tiles go through the UNet in one call. Higher is faster until memory runs out.",
+        default=1,
+        ge=1,
+        ui_order=13,
+    )
+    skip_residual_decay: float = InputField(
+        title="Skip Residual Decay",
+        description="How quickly each phase lets go of the upsampled previous phase. Higher values let go sooner.",
+        default=3.0,
+        ge=0,
+        ui_order=14,
+    )
+    blend_decay: float = InputField(
+        title="Local/Global Decay",
+        description="How quickly the prediction moves from dilated (global) to tiled (local). Higher values move sooner.",
+        default=1.0,
+        ge=0,
+        ui_order=15,
+    )
+    gaussian_decay_rate: float = InputField(
+        title="Gaussian Decay Rate",
+        description="The decay rate of the blur applied before dilated sampling. Higher values will result in less blurring in later timesteps.",
+        default=1.0,
+        ge=0,
+        ui_order=16,
+    )
+    skip_threshold: float = InputField(
+        title="Skip Threshold",
+        description="When the local or global weight is below this, that branch is not computed, saving a full UNet pass on those steps. 0 always computes both.",
+        default=0.01,
+        ge=0,
+        le=0.5,
+        ui_order=17,
+    )
+
+    def run_denoise(
+        self,
+        context: InvocationContext,
+        denoise_ctx: DenoiseContext,
+        ext_manager: ExtensionsManager,
+        sd_backend: StableDiffusionBackend,
+    ) -> torch.Tensor:
+        conditioning = denoise_ctx.inputs.conditioning_data
+        if conditioning.cond_regions is not None or conditioning.uncond_regions is not None:
+            raise ValueError("DemoFusion does not support regional prompts")
+        if context.models.get_config(self.unet.unet.key).variant == ModelVariantType.Inpaint:
+            raise ValueError("DemoFusion does not support inpainting models")
+
+        latents = sd_backend.latents_from_embeddings(denoise_ctx, ext_manager)
+
+        phase_extensions = [ext for ext in ext_manager._extensions if not isinstance(ext, BASE_ONLY_EXTENSIONS)]
+        for name in sorted({type(ext).__name__ for ext in ext_manager._extensions if isinstance(ext, BASE_ONLY_EXTENSIONS)}):
+            warning(f"DemoFusion: {name} only applies to the base resolution")
+
+        for scale in range(2, self.scale_factor + 1):
+            latents = self.run_phase(context, denoise_ctx, phase_extensions, latents, scale)
+        return latents
+
+    def run_phase(
+        self,
+        context: InvocationContext,
+        denoise_ctx: DenoiseContext,
+        phase_extensions: list[ExtensionBase],
+        latents: torch.Tensor,
+        scale: int,
+    ) -> torch.Tensor:
+        """Upsample `latents` to `scale` times the base size, re-noise them and denoise with local + global guidance"""
+        _, _, base_height, base_width = denoise_ctx.inputs.orig_latents.shape
+        height, width = base_height * scale, base_width * scale
+        device, dtype = latents.device, latents.dtype
+        TRACE.debug("DemoFusion", "phase x%d: %dx%d latents", scale, height, width)
+
+        reference = F.interpolate(latents.float(), size=(height, width), mode="bicubic", align_corners=False).to(dtype)
+        seed = denoise_ctx.inputs.seed + scale - 1
+        noise = get_noise(width * 8, height * 8, device, seed).to(device=device, dtype=dtype)
+
+        # same scheduler object, set_timesteps resets its state for the new phase
+        timesteps, init_timestep, scheduler_step_kwargs = self.init_scheduler(
+            denoise_ctx.scheduler,
+            seed=seed,
+            device=device,
+            steps=self.steps,
+            denoising_start=0.0,
+            denoising_end=1.0,
+        )
+        phase_ctx = DenoiseContext(
+            inputs=DenoiseInputs(
+                orig_latents=reference,
+                timesteps=timesteps,
+                init_timestep=init_timestep,
+                noise=noise,
+                seed=seed,
+                scheduler_step_kwargs=scheduler_step_kwargs,
+                conditioning_data=self.build_conditioning(context, height, width, device, dtype),
+                attention_processor_cls=denoise_ctx.inputs.attention_processor_cls,
+            ),
+            unet=denoise_ctx.unet,
+            scheduler=denoise_ctx.scheduler,
+        )
+        # a backend of its own, so no UNet forward wrapper of an earlier phase can carry over
+        sd_backend = StableDiffusionBackend(denoise_ctx.unet, denoise_ctx.scheduler)
+        phase_ctx.sd_backend = sd_backend
+
+        tile_size = min(base_height, base_width) * 8
+        phase_manager = ExtensionsManager(is_canceled=context.util.is_canceled)
+        for ext in phase_extensions:
+            phase_manager.add_extension(ext)
+        phase_manager.add_extension(SkipResidualGuidance(context, decay_rate=self.skip_residual_decay, reference=reference))
+        phase_manager.add_extension(
+            LocalGlobalBlendGuidance(
+                context,
+                tile_size=tile_size,
+                stride=min(self.stride, tile_size),
+                dilation_scale=scale,
+                tile_batch_size=self.tile_batch_size,
+                decay_rate=self.blend_decay,
+                gaussian_decay_rate=self.gaussian_decay_rate,
+                skip_threshold=self.skip_threshold,
+            )
+        )
+        # ext: t2i adapter states are sized to the latents
+        phase_manager.run_callback(ExtensionCallbackType.SETUP, phase_ctx)
+        return sd_backend.latents_from_embeddings(phase_ctx, phase_manager)
@@ -19,6 +19,7 @@ from invokeai.backend.model_manager import ModelVariantType
 from invokeai.backend.model_patcher import ModelPatcher
 from invokeai.backend.stable_diffusion import PipelineIntermediateState
 from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext, DenoiseInputs
+from invokeai.backend.stable_diffusion.diffusion.conditioning_data import TextConditioningData
 
 from invokeai.backend.stable_diffusion.diffusion.custom_atttention import CustomAttnProcessor2_0
 from invokeai.backend.stable_diffusion.diffusion_backend import StableDiffusionBackend
@@ -46,6 +47,7 @@ from invokeai.backend.util.logging import info, warning, error
 from pydantic import BaseModel
 
 from .extension_classes import SD12X_EXTENSIONS, GuidanceField, base_guidance_extension
+from .cache_utils import cached_conditioning_data
 
 
 
@@ -85,18 +87,10 @@ class ExposedDenoiseLatentsInvocation(DenoiseLatentsInvocation):
         ui_order=10,
     )
 
-    @torch.no_grad()
-    @SilenceWarnings()  # This quenches the NSFW nag from diffusers.
-    def invoke(self, context: InvocationContext) -> LatentsOutput:
-        ext_manager = ExtensionsManager(is_canceled=context.util.is_canceled)
-
-        device = TorchDevice.choose_torch_device()
-        dtype = TorchDevice.choose_torch_dtype()
-
-        seed, noise, latents = self.prepare_noise_and_latents(context, self.noise, self.latents)
-        _, _, latent_height, latent_width = latents.shape
-
-        conditioning_data = self.get_conditioning_data(
+    def build_conditioning(
+        self, context: InvocationContext, latent_height: int, latent_width: int, device: torch.device, dtype: torch.dtype
+    ) -> TextConditioningData:
+        return cached_conditioning_data(
             context=context,
             positive_conditioning_field=self.positive_conditioning,
             negative_conditioning_field=self.negative_conditioning,
@@ -110,22 +104,8 @@ class ExposedDenoiseLatentsInvocation(DenoiseLatentsInvocation):
             cfg_rescale_multiplier=self.cfg_rescale_multiplier,
         )
 
-        scheduler = get_scheduler(
-            context=context,
-            scheduler_info=self.unet.scheduler,
-            scheduler_name=self.scheduler,
-            seed=seed,
-        )
-
-        timesteps, init_timestep, scheduler_step_kwargs = self.init_scheduler(
-            scheduler,
-            seed=seed,
-            device=device,
-            steps=self.steps,
-            denoising_start=self.denoising_start,
-            denoising_end=self.denoising_end,
-        )
-
+    def add_extensions(self, context: InvocationContext, ext_manager: ExtensionsManager, latents: torch.Tensor):
+        """Guidance extensions from the inputs, then the stock ones the node settings ask for"""
         # user extensions
         if self.guidance_extensions:
             if not isinstance(self.guidance_extensions, list):
@@ -181,6 +161,48 @@ class ExposedDenoiseLatentsInvocation(DenoiseLatentsInvocation):
         elif mask is not None:
             ext_manager.add_extension(InpaintExt(mask, is_gradient_mask))
 
+    def run_denoise(
+        self,
+        context: InvocationContext,
+        denoise_ctx: DenoiseContext,
+        ext_manager: ExtensionsManager,
+        sd_backend: StableDiffusionBackend,
+    ) -> torch.Tensor:
+        """The denoise itself, run with the UNet loaded and patched. Subclasses can run more than one pass here
+        without reloading the model."""
+        return sd_backend.latents_from_embeddings(denoise_ctx, ext_manager)
+
+    @torch.no_grad()
+    @SilenceWarnings()  # This quenches the NSFW nag from diffusers.
+    def invoke(self, context: InvocationContext) -> LatentsOutput:
+        ext_manager = ExtensionsManager(is_canceled=context.util.is_canceled)
+
+        device = TorchDevice.choose_torch_device()
+        dtype = TorchDevice.choose_torch_dtype()
+
+        seed, noise, latents = self.prepare_noise_and_latents(context, self.noise, self.latents)
+        _, _, latent_height, latent_width = latents.shape
+
+        conditioning_data = self.build_conditioning(context, latent_height, latent_width, device, dtype)
+
+        scheduler = get_scheduler(
+            context=context,
+            scheduler_info=self.unet.scheduler,
+            scheduler_name=self.scheduler,
+            seed=seed,
+        )
+
+        timesteps, init_timestep, scheduler_step_kwargs = self.init_scheduler(
+            scheduler,
+            seed=seed,
+            device=device,
+            steps=self.steps,
+            denoising_start=self.denoising_start,
+            denoising_end=self.denoising_end,
+        )
+
+        self.add_extensions(context, ext_manager, latents)
+
         # Initialize context for modular denoise
         latents = latents.to(device=device, dtype=dtype)
         if noise is not None:
@@ -225,11 +247,11 @@ class ExposedDenoiseLatentsInvocation(DenoiseLatentsInvocation):
                 sd_backend = StableDiffusionBackend(unet, scheduler)
                 denoise_ctx.unet = unet
                 denoise_ctx.sd_backend = sd_backend # required for forced calls from extensions. Can this be done another way?
-                result_latents = sd_backend.latents_from_embeddings(denoise_ctx, ext_manager)
+                result_latents = self.run_denoise(context, denoise_ctx, ext_manager, sd_backend)
 
         # https://discuss.huggingface.co/t/memory-usage-by-later-pipeline-stages/23699
         result_latents = result_latents.detach().to("cpu")
         TorchDevice.empty_cache()
 
         name = context.tensors.save(tensor=result_latents)
-        return LatentsOutput.build(latents_name=name, latents=result_latents, seed=None)
\ No newline at end of file
+        return LatentsOutput.build(latents_name=name, latents=result_latents, seed=None)
@@ -9,9 +9,10 @@ from invokeai.invocation_api import (
     LatentsOutput,
     InvocationContext,
 )
+import torch
 from pydantic import BaseModel
 from invokeai.app.invocations.fields import Field
-from typing import Type, Any
+from typing import Type, Any, Callable
 from invokeai.backend.util.logging import info, warning, error
 
 SD12X_EXTENSIONS = {}
@@ -26,6 +27,69 @@ def base_guidance_extension(name: str):
         return cls
     return decorator
 
+_NO_OVERRIDE = object()
+
+def wrap_unet_forward(sd_backend: Any, wrapper: Callable[..., Any]) -> Callable[[], None]:
+    """Route the backend's UNet forward through `wrapper(default, **unet_kwargs)`, where `default` is the forward
+    with every wrapper added before this one.
+    Wrappers live in a stack on the backend, and the returned function removes only its own entry, so extensions
+    can unwrap in any order (POST_DENOISE_LOOP runs in registration order, not in reverse)."""
+    wrappers = getattr(sd_backend, "_unet_forward_wrappers", None)
+    if wrappers is None:
+        wrappers = []
+        raw_forward = sd_backend._unet_forward
+
+        def call(depth: int, kwargs: dict[str, Any]) -> Any:
+            if depth < 0:
+                return raw_forward(**kwargs)
+            return wrappers[depth][0](lambda **inner: call(depth - 1, inner), **kwargs)
+
+        def _forward(**kwargs):
+            return call(len(wrappers) - 1, kwargs)
+
+        sd_backend._unet_forward_wrappers = wrappers
+        sd_backend._unet_forward_raw = raw_forward
+        # an instance override that was there before wrapping is put back; otherwise the class method shows through again
+        sd_backend._unet_forward_override = vars(sd_backend).get("_unet_forward", _NO_OVERRIDE)
+        sd_backend._unet_forward = _forward
+
+    entry = (wrapper,) # identity of this wrap, even if the same function is wrapped twice
+    wrappers.append(entry)
+
+    def restore():
+        for i, e in enumerate(wrappers):
+            if e is entry:
+                del wrappers[i]
+                break
+        if not wrappers and getattr(sd_backend, "_unet_forward_wrappers", None) is wrappers:
+            if sd_backend._unet_forward_override is _NO_OVERRIDE:
+                del sd_backend._unet_forward
+            else:
+                sd_backend._unet_forward = sd_backend._unet_forward_override
+            del sd_backend._unet_forward_wrappers
+            del sd_backend._unet_forward_raw
+            del sd_backend._unet_forward_override
+
+    return restore
+
+def scale_model_input_at(scheduler: Any, sample: Any, timestep: Any) -> Any:
+    """scheduler.scale_model_input for a timestep that is not the current step.
+    Schedulers like Euler set their step index from the first timestep they are asked to scale, which would
+    throw off the real step if an extension scaled some other timestep first."""
+    step_index = getattr(scheduler, "_step_index", None)
+    scaled = scheduler.scale_model_input(sample, timestep)
+    if hasattr(scheduler, "_step_index"):
+        scheduler._step_index = step_index
+    return scaled
+
+def add_noise_coefficients(scheduler: Any, timesteps: Any, device: Any) -> tuple[Any, Any]:
+    """(a_t, b_t) per timestep such that scheduler.add_noise(x, n, t) == a_t * x + b_t * n.
+    add_noise is linear in both arguments, so two probes give the coefficients for every timestep at once."""
+    timesteps = timesteps.to(device)
+    ones = torch.ones(len(timesteps), device=device)
+    zeros = torch.zeros(len(timesteps), device=device)
+    return scheduler.add_noise(ones, zeros, timesteps).float(), scheduler.add_noise(zeros, ones, timesteps).float()
+
 class GuidanceField(BaseModel):
     """Guidance information for extensions in the denoising process."""
     guidance_name: str = Field(description="The name of the guidance extension class")
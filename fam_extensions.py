@@ -11,20 +11,42 @@ from invokeai.app.invocations.fields import (
 )
 
 import torch
-from .extension_classes import GuidanceField, base_guidance_extension, GuidanceDataOutput
+from .extension_classes import GuidanceField, base_guidance_extension, GuidanceDataOutput, scale_model_input_at, add_noise_coefficients
 from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase, callback
 from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
-from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext, UNetKwargs
 from invokeai.backend.util.logging import info, warning, error
-import random
 import einops
 from diffusers import UNet2DConditionModel
-from typing import Type, Any
-from .attention_modulation import StoreAttentionModulation
+from typing import Type, Any, Literal, Optional
+from dataclasses import replace
+from .debug_trace import TRACE
+from .cache_utils import LOADED_TENSORS, cached_tensor
+from .layer_selection import LAYER_PRESETS, LayerCost, select_layers, estimate_layer_costs, format_cost_report
+from .attention_modulation import ATTENTION_STORAGE_MODES, StoreAttentionModulation
 from invokeai.backend.stable_diffusion.extensions_manager import ExtensionsManager
 from invokeai.backend.stable_diffusion.diffusion.conditioning_data import ConditioningMode
 
 
+def reference_noise(ctx: DenoiseContext, shape: torch.Size, seed: Optional[int], dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+    """Noise for the skip residual / reference pass, reproducible from the seed.
+    With no seed of its own the extension follows the denoise seed, and reuses the denoise noise when it has the
+    same shape; otherwise the noise is generated directly on the latents' device."""
+    dtype = ctx.latents.dtype if dtype is None else dtype
+    if seed is None:
+        if ctx.inputs.noise is not None and ctx.inputs.noise.shape == shape:
+            return ctx.inputs.noise.to(device=ctx.latents.device, dtype=dtype)
+        seed = ctx.inputs.seed
+    device = ctx.latents.device
+    generator_device = device if device.type == "cuda" else torch.device("cpu")
+    return torch.randn(
+        shape,
+        dtype=torch.float32,
+        device=generator_device,
+        generator=torch.Generator(device=generator_device).manual_seed(seed),
+    ).to(device=device, dtype=dtype)
+
+
 @base_guidance_extension("FAM_FM")
 class FAM_FM_Guidance(ExtensionBase):
     def __init__(
@@ -32,57 +54,113 @@ class FAM_FM_Guidance(ExtensionBase):
         context: InvocationContext,
         c: float,
         latent_image_name: str,
+        seed: Optional[int] = None,
     ):
         self.c = c
-        self.initial_latents = context.tensors.load(latent_image_name)
-        self.noise = torch.randn(
-            self.initial_latents.shape,
-            dtype=torch.float32,
-            device="cpu",
-            generator=torch.Generator(device="cpu").manual_seed(random.randint(0, 2 ** 32 - 1)),
-        ).to(device=self.initial_latents.device, dtype=self.initial_latents.dtype)
+        self.context = context
+        self.latent_image_name = latent_image_name
+        self.initial_latents = cached_tensor(context, latent_image_name)
+        self.seed = seed
+        self.noise: Optional[torch.Tensor] = None # made in PRE_DENOISE_LOOP, once the device and seed are known
         super().__init__()
     
-    @callback(ExtensionCallbackType.PRE_STEP)
-    @torch.no_grad()
-    def pre_step(self, ctx: DenoiseContext):
-        t = ctx.timestep
-        if t.dim() == 0:
-            t = einops.repeat(t, "-> batch", batch=ctx.latents.size(0))
-        
-        latents = ctx.latents.clone().double()
-        latents_fft = torch.fft.fftshift(torch.fft.fft2(latents, s=None, dim=(-2, -1), norm="ortho"))
-        skip_residual = ctx.scheduler.add_noise(self.initial_latents, self.noise.to(self.initial_latents.device), t).double()
-        skip_residual_fft = torch.fft.fftshift(torch.fft.fft2(skip_residual, s=None, dim=(-2, -1), norm="ortho").to(ctx.latents.device))
-        K_t = torch.ones_like(self.initial_latents).to(ctx.latents.device)
-        
-        rho = ctx.timestep.item() / ctx.scheduler.config.num_train_timesteps
-        h_i = self.initial_latents.shape[-2]
-        w_i = self.initial_latents.shape[-1]
-        tau_h = h_i * self.c * (1 - rho)
-        tau_w = w_i * self.c * (1 - rho)
-
-        h_d = latents.shape[-2]
-        w_d = latents.shape[-1]
-
-        # create a high-pass filter on the shifted domain
+    @staticmethod
+    def high_pass_mask(h_i: int, w_i: int, tau_h: float, tau_w: float, rho: float, device: torch.device) -> torch.Tensor:
+        """K_t on the shifted frequency domain: 1 - rho inside the centered low frequency box, 1 elsewhere"""
         # in horizontal dimension: K_t = rho if |X - Xc| < tau_w/2 else 1
         # in vertical dimension: K_t = rho if |Y - Yc| < tau_h/2 else 1
-        K_t[:, :, int((h_i // 2) - (tau_h // 2)): int((h_i // 2) + (tau_h // 2)), int((w_i // 2) - (tau_w // 2)): int((w_i // 2) + (tau_w // 2))] = 1 - rho #paper formulas are wrong, missing 1-
+        K_t = torch.ones((h_i, w_i), dtype=torch.float32, device=device)
+        K_t[int((h_i // 2) - (tau_h // 2)): int((h_i // 2) + (tau_h // 2)), int((w_i // 2) - (tau_w // 2)): int((w_i // 2) + (tau_w // 2))] = 1 - rho #paper formulas are wrong, missing 1-
+        return K_t
+
+    @staticmethod
+    def real_spectrum_mask(K_t: torch.Tensor) -> torch.Tensor:
+        """Turn a shifted full-spectrum mask into the equivalent mask for an unshifted rfft2 spectrum.
+        Taking .real of the full inverse FFT only sees the mask averaged with its mirror, so symmetrizing it
+        gives the same result with half the work."""
+        K_u = torch.fft.ifftshift(K_t, dim=(-2, -1))
+        K_mirror = torch.roll(torch.flip(K_u, dims=(-2, -1)), shifts=(1, 1), dims=(-2, -1)) # K(-f)
+        return ((K_u + K_mirror) / 2)[..., : K_t.shape[-1] // 2 + 1]
 
-        lf_part = skip_residual_fft * (1 - K_t)
+    @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
+    @torch.no_grad()
+    def pre_denoise_loop(self, ctx: DenoiseContext):
+        """Everything in the blend except the latents' own FFT is known before the loop starts:
+        the filter only depends on rho and the two shapes, and the skip residual is a fixed latent and noise mixed with
+        per-timestep add_noise coefficients, so its spectrum is a mix of two spectra computed once here."""
+        device = ctx.latents.device
+        timesteps = ctx.inputs.timesteps.to(device)
+        num_train_timesteps = ctx.scheduler.config.num_train_timesteps
+        h_i, w_i = self.initial_latents.shape[-2:]
+        h_d, w_d = ctx.latents.shape[-2:]
+        self.same_size = (h_d, w_d) == (h_i, w_i)
+        self.noise = reference_noise(ctx, self.initial_latents.shape, self.seed, torch.float32)
+
+        self.latent_coefficients, self.noise_coefficients = add_noise_coefficients(ctx.scheduler, timesteps, device)
+
+        initial_latents = cached_tensor(self.context, self.latent_image_name, device, torch.float32)
+        noise = self.noise
 
-        # pad the low frequency part equally in both directions with zeros
         pad_h = h_d - h_i
         pad_w = w_d - w_i
-        lf_part = torch.nn.functional.pad(lf_part, (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2), mode='constant', value=0)
-        K_t_padded = torch.nn.functional.pad(K_t, (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2), mode='constant', value=1)
+        padding = (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2)
+
+        def embed(spectrum: torch.Tensor) -> torch.Tensor:
+            """small unshifted spectrum -> large unshifted spectrum, with zeros for the new frequencies"""
+            shifted = torch.fft.fftshift(spectrum, dim=(-2, -1))
+            return torch.fft.ifftshift(torch.nn.functional.pad(shifted, padding, mode='constant', value=0), dim=(-2, -1))
+
+        if self.same_size:
+            self.latent_spectrum = torch.fft.rfft2(initial_latents, dim=(-2, -1), norm="ortho")
+            self.noise_spectrum = torch.fft.rfft2(noise, dim=(-2, -1), norm="ortho")
+        else:
+            self.latent_spectrum = embed(torch.fft.fft2(initial_latents, dim=(-2, -1), norm="ortho"))
+            self.noise_spectrum = embed(torch.fft.fft2(noise, dim=(-2, -1), norm="ortho"))
+
+        # per-step masks, already in the layout of the spectrum they multiply
+        high_pass = []
+        low_pass = []
+        for t in timesteps:
+            rho = t.item() / num_train_timesteps
+            tau_h = h_i * self.c * (1 - rho)
+            tau_w = w_i * self.c * (1 - rho)
+            K_t = self.high_pass_mask(h_i, w_i, tau_h, tau_w, rho, device)
+            if self.same_size:
+                K_r = self.real_spectrum_mask(K_t)
+                high_pass.append(K_r)
+                low_pass.append(1 - K_r)
+            else:
+                high_pass.append(torch.fft.ifftshift(torch.nn.functional.pad(K_t, padding, mode='constant', value=1)))
+                low_pass.append(torch.fft.ifftshift(torch.nn.functional.pad(1 - K_t, padding, mode='constant', value=0)))
+        self.high_pass = torch.stack(high_pass)
+        self.low_pass = torch.stack(low_pass)
+
+    @callback(ExtensionCallbackType.PRE_STEP)
+    @torch.no_grad()
+    def pre_step(self, ctx: DenoiseContext):
+        i = ctx.step_index
+        latents = ctx.latents
+        h_d, w_d = latents.shape[-2:]
+
+        skip_residual_fft = self.latent_coefficients[i] * self.latent_spectrum + self.noise_coefficients[i] * self.noise_spectrum
 
         #combine the low frequency components of the skip residual with the high frequency components of the latent image
-        latents_fft = latents_fft * K_t_padded + lf_part
+        if self.same_size:
+            latents_fft = torch.fft.rfft2(latents.float(), dim=(-2, -1), norm="ortho")
+            latents_fft = latents_fft * self.high_pass[i] + skip_residual_fft * self.low_pass[i]
+            ctx.latents = torch.fft.irfft2(latents_fft, s=(h_d, w_d), dim=(-2, -1), norm="ortho").to(latents.dtype)
+        else:
+            latents_fft = torch.fft.fft2(latents.float(), dim=(-2, -1), norm="ortho")
+            latents_fft = latents_fft * self.high_pass[i] + skip_residual_fft * self.low_pass[i]
+            ctx.latents = torch.fft.ifft2(latents_fft, dim=(-2, -1), norm="ortho").real.to(latents.dtype)
 
-        #invert the FFT to get the new latent image
-        ctx.latents = torch.fft.ifft2(torch.fft.ifftshift(latents_fft), s=None, dim=(-2, -1), norm="ortho").real.half()
+    @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
+    def post_denoise_loop(self, ctx: DenoiseContext):
+        self.high_pass = None
+        self.low_pass = None
+        self.latent_spectrum = None
+        self.noise_spectrum = None
+        self.noise = None
 
 
 @invocation(
@@ -90,7 +168,7 @@ class FAM_FM_Guidance(ExtensionBase):
     title="I2I Preservation (FM) [Extension]",
     tags=["FAM", "frequency", "modulation", "extension"],
     category="latents",
-    version="1.0.3",
+    version="1.1.0",
 )
 class FAM_FM_ExtensionInvocation(BaseInvocation):
     """Preserves low frequency features from an input image."""
@@ -105,12 +183,19 @@ class FAM_FM_ExtensionInvocation(BaseInvocation):
         title="Latent Image",
         description="Latent image to be targeted.",
     )
+    seed: Optional[int] = InputField(
+        title="Seed",
+        description="Seed for the noise added to the reference latents. Leave empty to follow the denoise seed (and reuse its noise when the sizes match), so runs are reproducible.",
+        default=None,
+        ge=0,
+    )
 
     @torch.no_grad()
     def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
         kwargs = {
             "c": self.c,
             "latent_image_name": self.latent_image.latents_name,
+            "seed": self.seed,
         }
         return GuidanceDataOutput(
             guidance_data_output=GuidanceField(
@@ -147,15 +232,32 @@ class FAM_AM_Guidance(ExtensionBase):
         context: InvocationContext,
         l: float,
         latent_image_name: str,
+        query_chunk_size: int = 1024,
+        storage_mode: ATTENTION_STORAGE_MODES = "dense",
+        storage_rank: int = 64,
+        storage_top_k: int = 64,
+        layer_selection: str = "up block 0 cross-attn",
+        memory_budget_mb: int = 0,
+        over_budget: Literal["refuse", "downgrade"] = "downgrade",
+        reference_levels: int = 1,
+        level_blend: Literal["nearest", "interpolate"] = "nearest",
+        seed: Optional[int] = None,
     ):
         self.l = l
-        self.initial_latents = context.tensors.load(latent_image_name)
-        self.noise = torch.randn(
-            self.initial_latents.shape,
-            dtype=torch.float32,
-            device="cpu",
-            generator=torch.Generator(device="cpu").manual_seed(random.randint(0, 2 ** 32 - 1)),
-        ).to(device=self.initial_latents.device, dtype=self.initial_latents.dtype)
+        self.reference_levels = reference_levels
+        self.level_blend = level_blend
+        self.layer_selection = layer_selection
+        self.memory_budget_mb = memory_budget_mb
+        self.over_budget = over_budget
+        self.query_chunk_size = query_chunk_size
+        self.storage_mode = storage_mode
+        self.storage_rank = storage_rank
+        self.storage_top_k = storage_top_k
+        self.context = context
+        self.latent_image_name = latent_image_name
+        self.initial_latents = cached_tensor(context, latent_image_name)
+        self.seed = seed
+        self.noise: Optional[torch.Tensor] = None # made in PRE_DENOISE_LOOP, once the device and seed are known
         self.dummy_manager = ExtensionsManager()
         self.and_never_again = False
         super().__init__()
@@ -166,38 +268,87 @@ class FAM_AM_Guidance(ExtensionBase):
             Setting all processors to use the custom attention makes the process take 2x longer
             It also requires an extra 12GB of GPU memory at SDXL 1024x1024 resolution just to hold coppies of the attention weights.
             The paper specifies that they only use it for the up_blocks, and that the most significant effect is up_block_0.
-            Since there is no published code, it's worth playing around with which ones are activated. Potentially allow a list of string inputs to specify block options.
+            Since there is no published code, it's worth playing around with which ones are activated; the layer selection spec picks them.
         """
         #key is in form 'up_blocks.0.attentions.2.transformer_blocks.0.attn1.processor'
-        blocks = key.split('.')
-        if blocks[0] == 'up_blocks':
-            if (blocks[1] == "0" and blocks[6] == "attn2"):
-                print(f"Custom attention for {key}")
-                return True
-
-
-    
+        return key in self.selected_layers
+
+    def stored_map_bytes(self, cost: LayerCost, bytes_per_element: int) -> int:
+        """Bytes of one stored attention map in the chosen storage mode, plus one chunk of attention weights in flight"""
+        rows = cost.attention_map_bytes // (bytes_per_element * cost.key_tokens) # batch * heads * query tokens
+        chunk = min(self.query_chunk_size or cost.query_tokens, cost.query_tokens)
+        in_flight = cost.attention_map_bytes * chunk // cost.query_tokens
+        if self.storage_mode == "fp16":
+            stored = rows * cost.key_tokens * 2
+        elif self.storage_mode == "int8":
+            stored = rows * (cost.key_tokens + 2)
+        elif self.storage_mode == "low rank":
+            rank = min(self.storage_rank, cost.query_tokens, cost.key_tokens)
+            stored = (rows + rows // cost.query_tokens * cost.key_tokens) * rank * bytes_per_element
+        elif self.storage_mode == "top-k":
+            top_k = min(self.storage_top_k, cost.key_tokens)
+            stored = rows * top_k * (bytes_per_element + (2 if cost.key_tokens <= 32767 else 4))
+        else:
+            stored = cost.attention_map_bytes
+        return stored * max(self.reference_levels, 1) + in_flight
+
+    def select_within_budget(self, ctx: DenoiseContext) -> list[str]:
+        """Apply the layer spec, log the estimated cost of the selection, and enforce the memory budget.
+        The maps are stored at the size of the reference latents, so that is what the estimate uses."""
+        all_layers = list(ctx.unet.attn_processors.keys())
+        selected = select_layers(all_layers, self.layer_selection)
+        bytes_per_element = torch.finfo(ctx.latents.dtype).bits // 8
+        h, w = self.initial_latents.shape[-2:]
+
+        def with_storage(costs: list[LayerCost]) -> list[LayerCost]:
+            return [replace(c, attention_map_bytes=self.stored_map_bytes(c, bytes_per_element)) for c in costs]
+
+        costs = with_storage(estimate_layer_costs(ctx.unet, selected, h, w, bytes_per_element=bytes_per_element))
+        info(f"FAM_AM layer selection '{self.layer_selection}' cost ({self.storage_mode} storage):\n" + format_cost_report(
+            costs, with_storage(estimate_layer_costs(ctx.unet, all_layers, h, w, bytes_per_element=bytes_per_element))
+        ))
+
+        budget = self.memory_budget_mb * 2**20
+        total = sum(c.attention_map_bytes for c in costs)
+        if budget <= 0 or total <= budget:
+            return selected
+        if self.over_budget == "refuse":
+            raise ValueError(
+                f"FAM_AM layer selection '{self.layer_selection}' needs an estimated {total / 2**20:.0f}MB for attention maps, "
+                f"over the {self.memory_budget_mb}MB budget. Select fewer layers, use a compressed storage mode, or raise the budget."
+            )
+        # drop the most expensive layers until the rest fits
+        dropped = []
+        for cost in sorted(costs, key=lambda c: c.attention_map_bytes, reverse=True):
+            if total <= budget:
+                break
+            total -= cost.attention_map_bytes
+            dropped.append(cost.key)
+        warning(
+            f"FAM_AM layer selection is over the {self.memory_budget_mb}MB budget, dropped {len(dropped)} layers: {dropped}. "
+            f"{len(selected) - len(dropped)} layers left, estimated {total / 2**20:.0f}MB."
+        )
+        return [k for k in selected if k not in dropped]
 
     @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
     def pre_denoise_loop(self, ctx: DenoiseContext):
-
-        #DEBGUG print out the keys of the named modules in the unet
-        # for key, obj in enumerate(ctx.unet.named_modules()):
-        #     print(obj)
-
-
+        self.initial_latents = cached_tensor(self.context, self.latent_image_name, ctx.latents.device)
+        TRACE.debug("FAM_AM", "loaded tensor cache %s", LOADED_TENSORS.stats())
+        if self.reference_levels > 1:
+            self.noise = reference_noise(ctx, self.initial_latents.shape, self.seed)
         unet_replacement_processors = {}
         self.unet_new_processors = []
-
-        for block in ctx.unet.up_blocks:
-            print(f"up_block - {type(block)}")
+        self.selected_layers = set(self.select_within_budget(ctx))
 
         for key in ctx.unet.attn_processors.keys():
             if self.is_custom_attention(key):
-                unet_replacement_processors[key] = StoreAttentionModulation(self.l)
+                unet_replacement_processors[key] = StoreAttentionModulation(
+                    self.l, self.query_chunk_size, self.storage_mode, self.storage_rank, self.storage_top_k
+                )
                 self.unet_new_processors.append(unet_replacement_processors[key])
                 unet_replacement_processors[key].debugname = key
-                print(f"added custom attention for {key}")
+                unet_replacement_processors[key].reference_levels = max(self.reference_levels, 1)
+                TRACE.debug("FAM_AM", "added custom attention for %s", key)
             else:
                 unet_replacement_processors[key] = ctx.unet.attn_processors[key]
 
@@ -208,6 +359,12 @@ class FAM_AM_Guidance(ExtensionBase):
     @callback(ExtensionCallbackType.PRE_STEP)
     @torch.no_grad()
     def pre_step(self, ctx: DenoiseContext):
+        if self.reference_levels > 1 and self.unet_new_processors:
+            if not self.and_never_again:
+                self.run_level_reference(ctx)
+                self.and_never_again = True
+            self.select_reference_level(ctx)
+            return
         if self.and_never_again:
             return
 
@@ -225,23 +382,121 @@ class FAM_AM_Guidance(ExtensionBase):
             attn_processor.store_copy = True
         
         #call the unet step to get the attention weights
-        print("Running unet with store_copy set to True")
+        TRACE.debug("FAM_AM", "running reference pass at timestep %s", ctx.timestep)
         ctx.sd_backend.run_unet(ctx, self.dummy_manager, ConditioningMode.Both)
 
         #Change back to false, attentions will use the stored maps in the real unet pass
         for attn_processor in self.unet_new_processors:
             attn_processor.store_copy = False
+        self.report_storage()
         
         ctx.latents = self.stored_latents
         ctx.timestep = t_orig
         self.and_never_again = True
-        print("Finished pre_step")
     
+    @torch.no_grad()
+    def run_level_reference(self, ctx: DenoiseContext):
+        """Store reference attention at reference_levels timesteps spread over the schedule, with the reference latents
+        noised to each of them. All levels go through a single UNet call, stacked along the batch."""
+        timesteps = ctx.inputs.timesteps
+        picks = torch.linspace(0, len(timesteps) - 1, self.reference_levels).round().long().unique()
+        level_timesteps = timesteps[picks.to(timesteps.device)].to(ctx.latents.device)
+        self.level_timesteps = level_timesteps.tolist()
+        levels = len(self.level_timesteps)
+
+        initial_latents = self.initial_latents.to(device=ctx.latents.device, dtype=ctx.latents.dtype)
+        noise = self.noise
+        samples = []
+        for t in level_timesteps:
+            noised = ctx.scheduler.add_noise(initial_latents, noise, t.repeat(initial_latents.shape[0]))
+            samples.append(scale_model_input_at(ctx.scheduler, noised, t))
+
+        for attn_processor in self.unet_new_processors:
+            attn_processor.store_copy = True
+            attn_processor.reference_levels = levels
+
+        conditioning = ctx.inputs.conditioning_data
+        TRACE.debug("FAM_AM", "running reference pass at timesteps %s", self.level_timesteps)
+        if conditioning.cond_regions is None and conditioning.uncond_regions is None:
+            # [uncond level 0..n-1, cond level 0..n-1], which is the order the processors split the stored maps in
+            sample = torch.cat(samples)
+            unet_kwargs = UNetKwargs(
+                sample=torch.cat([sample, sample]),
+                timestep=level_timesteps.repeat(2),
+                encoder_hidden_states=None,
+            )
+            conditioning.to_unet_kwargs(unet_kwargs, ConditioningMode.Both)
+            unet_kwargs.encoder_hidden_states = unet_kwargs.encoder_hidden_states.repeat_interleave(levels, dim=0)
+            if unet_kwargs.added_cond_kwargs is not None:
+                unet_kwargs.added_cond_kwargs = {
+                    k: v.repeat_interleave(levels, dim=0) for k, v in unet_kwargs.added_cond_kwargs.items()
+                }
+            ctx.unet(**vars(unet_kwargs)).sample
+        else:
+            # regional prompt masks are built per call for the normal batch, so run the levels one at a time
+            level_copies = {p: [] for p in self.unet_new_processors}
+            stored_latents, t_orig = ctx.latents, ctx.timestep
+            for attn_processor in self.unet_new_processors:
+                attn_processor.reference_levels = 1
+            for t, sample in zip(level_timesteps, samples):
+                ctx.timestep = t
+                ctx.latent_model_input = sample
+                ctx.sd_backend.run_unet(ctx, self.dummy_manager, ConditioningMode.Both)
+                for attn_processor in self.unet_new_processors:
+                    level_copies[attn_processor].append(attn_processor.stored_copy)
+            ctx.latents, ctx.timestep = stored_latents, t_orig
+            for attn_processor in self.unet_new_processors:
+                attn_processor.level_copies = level_copies[attn_processor]
+                attn_processor.dense_nbytes *= levels
+                attn_processor.reference_levels = levels
+
+        for attn_processor in self.unet_new_processors:
+            attn_processor.store_copy = False
+        self.report_storage()
+
+    def select_reference_level(self, ctx: DenoiseContext):
+        """Point the processors at the stored level nearest to this step's timestep, or at the two levels around it"""
+        t = ctx.timestep.item()
+        levels = self.level_timesteps # descending, like the schedule
+        if self.level_blend == "nearest" or len(levels) == 1:
+            nearest = min(range(len(levels)), key=lambda i: abs(levels[i] - t))
+            choice = (nearest, None, 0.0)
+        elif t >= levels[0]:
+            choice = (0, None, 0.0)
+        elif t <= levels[-1]:
+            choice = (len(levels) - 1, None, 0.0)
+        else:
+            i = next(i for i in range(len(levels) - 1) if levels[i] >= t >= levels[i + 1])
+            choice = (i, i + 1, (levels[i] - t) / (levels[i] - levels[i + 1]))
+        TRACE.debug("FAM_AM", "step %d uses reference level %s", ctx.step_index, choice)
+        for attn_processor in self.unet_new_processors:
+            attn_processor.select_level(*choice)
+
+    def report_storage(self):
+        """Log how much the stored attention maps take in the chosen storage mode, and how far they are from the originals.
+        The blend is a lerp, so the error it passes on to the attention is l times the map error."""
+        processors = [p for p in self.unet_new_processors if getattr(p, "stored_copy", None) is not None]
+        if not processors:
+            return
+        dense = sum(p.dense_nbytes for p in processors)
+        stored = sum(p.stored_nbytes() for p in processors)
+        worst = max(processors, key=lambda p: p.storage_error)
+        mean_error = sum(p.storage_error for p in processors) / len(processors)
+        info(
+            f"FAM_AM reference maps ({self.storage_mode}): {stored / 2**20:.1f}MB stored vs {dense / 2**20:.1f}MB dense, "
+            f"saved {(dense - stored) / 2**20:.1f}MB. Map error mean {mean_error:.4f}, worst {worst.storage_error:.4f} "
+            f"({worst.debugname}); blend error mean {self.l * mean_error:.4f}"
+        )
+
     @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
     def post_denoise_loop(self, ctx: DenoiseContext):
         for attn_processor in self.unet_new_processors:
             attn_processor.stored_copy = None
+            attn_processor.level_copies = []
+            attn_processor.level_blend = None
+        self.noise = None
         torch.cuda.empty_cache()
+        TRACE.flush()
         
 
 @invocation(
@@ -249,7 +504,7 @@ class FAM_AM_Guidance(ExtensionBase):
     title="I2I Preservation (AM) [Extension]",
     tags=["FAM", "attention", "modulation", "extension"],
     category="latents",
-    version="1.0.0",
+    version="1.5.0",
 )
 class FAM_AM_ExtensionInvocation(BaseInvocation):
     """Preserves low frequency features from an input image."""
@@ -265,11 +520,79 @@ class FAM_AM_ExtensionInvocation(BaseInvocation):
         description="Latent image to be targeted.",
     )
 
+    query_chunk_size: int = InputField(
+        title="Query Chunk Size",
+        description="Attention is computed over this many query tokens at a time so the full attention map is never held. 0 computes all queries at once (fastest, most memory).",
+        default=1024,
+        ge=0,
+    )
+    storage_mode: ATTENTION_STORAGE_MODES = InputField(
+        title="Reference Storage",
+        description="How the reference attention maps are stored between the reference pass and the blend. fp16/int8 quantize, low rank keeps a rank-k factorization, top-k keeps the largest entries of each row. The log reports memory saved and the resulting error.",
+        default="dense",
+    )
+    storage_rank: int = InputField(
+        title="Storage Rank",
+        description="Rank kept by the 'low rank' storage mode.",
+        default=64,
+        ge=1,
+    )
+    storage_top_k: int = InputField(
+        title="Storage Top K",
+        description="Entries kept per attention row by the 'top-k' storage mode.",
+        default=64,
+        ge=1,
+    )
+
+    layer_selection: str = InputField(
+        title="Layer Selection",
+        description="Attention layers to apply attention modulation to. Comma separated presets (" + ", ".join(LAYER_PRESETS) + "), globs like 'up_blocks.0.*attn2', or 're:' regexes. Prefix a term with '!' to remove it.",
+        default="up block 0 cross-attn",
+    )
+    memory_budget_mb: int = InputField(
+        title="Memory Budget (MB)",
+        description="Estimated memory allowed for the stored attention maps of the selected layers. 0 means no limit.",
+        default=0,
+        ge=0,
+    )
+    over_budget: Literal["refuse", "downgrade"] = InputField(
+        title="Over Budget",
+        description="What to do when the selection is estimated to exceed the memory budget: fail the node, or drop the most expensive layers until it fits.",
+        default="downgrade",
+    )
+    reference_levels: int = InputField(
+        title="Reference Levels",
+        description="1 stores the reference attention once from the clean reference latents. Higher values store it at this many noise levels spread over the schedule, all in one batched UNet call, and each step uses the level matching its timestep. Memory for stored maps scales with the count.",
+        default=1,
+        ge=1,
+    )
+    level_blend: Literal["nearest", "interpolate"] = InputField(
+        title="Level Blend",
+        description="With several reference levels, use the nearest level for each step or interpolate between the two around it.",
+        default="nearest",
+    )
+    seed: Optional[int] = InputField(
+        title="Seed",
+        description="Seed for the noise added to the reference latents. Leave empty to follow the denoise seed (and reuse its noise when the sizes match), so runs are reproducible.",
+        default=None,
+        ge=0,
+    )
+
     @torch.no_grad()
     def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
         kwargs = {
             "l": self.l,
+            "seed": self.seed,
+            "reference_levels": self.reference_levels,
+            "level_blend": self.level_blend,
+            "layer_selection": self.layer_selection,
+            "memory_budget_mb": self.memory_budget_mb,
+            "over_budget": self.over_budget,
             "latent_image_name": self.latent_image.latents_name,
+            "query_chunk_size": self.query_chunk_size,
+            "storage_mode": self.storage_mode,
+            "storage_rank": self.storage_rank,
+            "storage_top_k": self.storage_top_k,
         }
         return GuidanceDataOutput(
             guidance_data_output=GuidanceField(
@@ -31,6 +31,7 @@ from invokeai.app.invocations.constants import LATENT_SCALE_FACTOR
 from invokeai.backend.stable_diffusion.extensions.inpaint import InpaintExt
 
 from .extension_classes import GuidanceField, base_guidance_extension
+from .cache_utils import cached_tensor
 
 
 
@@ -59,13 +60,16 @@ class InpaintMaskGuidance(InpaintExt):
         This override is purely to adapt the Invoke internal extension to accept the mask_name as a string.
         """
         super(InpaintExt,self).__init__() # skip the super call to the InvokeAI version
-        self._mask = context.tensors.load(mask_name)
+        self._context = context
+        self._mask_name = mask_name
+        self._mask = cached_tensor(context, mask_name)
         self._is_gradient_mask = is_gradient_mask
         self._noise: Optional[torch.Tensor] = None
 
     @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
     def init_tensors(self, ctx: DenoiseContext):
-        self._mask = tv_resize(self._mask, ctx.latents.shape[-2:], T.InterpolationMode.BILINEAR, antialias=False)
+        mask = cached_tensor(self._context, self._mask_name, ctx.latents.device)
+        self._mask = tv_resize(mask, ctx.latents.shape[-2:], T.InterpolationMode.BILINEAR, antialias=False)
         super().init_tensors(ctx)
 
 
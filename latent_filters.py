@@ -0,0 +1,114 @@
+####################################################################################################
+# Filters for latents, shared by the extensions
+####################################################################################################
+import time
+from typing import Literal
+
+import torch
+import torch.nn.functional as F
+
+from .cache_utils import TensorLRUCache
+from .debug_trace import TRACE
+
+BLUR_METHODS = Literal["auto", "conv", "fft"]
+
+# FFT kernel spectra are the size of the latent and make up most of the cache, so bound it by bytes.
+FILTER_KERNELS = TensorLRUCache(max_bytes=32 * 2**20)
+
+# Sigma is rounded to this step before building a kernel. The DemoFusion blur sigma moves with the timestep, so keyed
+# on the exact float no kernel or spectrum would ever be reused, across steps or across runs.
+SIGMA_STEP = 0.01
+
+# Which method is faster depends on the device, the latent size and the kernel size, so "auto" times both the first
+# time it sees a combination and keeps the winner. (kernel_size, channels, height, width, device, dtype) -> method
+BLUR_METHOD_CHOICE: dict[tuple, str] = {}
+
+
+def quantize_sigma(sigma: float) -> float:
+    """Sigma rounded to SIGMA_STEP, never below it"""
+    return max(round(float(sigma) / SIGMA_STEP), 1) * SIGMA_STEP
+
+
+def gaussian_kernel_1d(kernel_size: int, sigma: float, channels: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Normalized 1D Gaussian as a grouped conv1d weight, (channels, 1, kernel_size), cached by quantized sigma"""
+    sigma = quantize_sigma(sigma)
+    key = ("gaussian", kernel_size, sigma, channels, str(device), str(dtype))
+    kernel = FILTER_KERNELS.get(key)
+    if kernel is None:
+        x = torch.arange(kernel_size, device=device, dtype=torch.float32) - (kernel_size - 1) / 2
+        kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+        kernel = (kernel / kernel.sum()).to(dtype).view(1, 1, kernel_size).repeat(channels, 1, 1)
+        FILTER_KERNELS.put(key, kernel)
+    return kernel
+
+
+def _gaussian_spectrum(kernel_size: int, sigma: float, height: int, width: int, device: torch.device) -> torch.Tensor:
+    """rfft2 of the 2D Gaussian zero padded to (height, width). The kernel is separable, so this is the outer product
+    of two 1D spectra."""
+    sigma = quantize_sigma(sigma)
+    key = ("gaussian_fft", kernel_size, sigma, height, width, str(device))
+    spectrum = FILTER_KERNELS.get(key)
+    if spectrum is None:
+        kernel = gaussian_kernel_1d(kernel_size, sigma, 1, device, torch.float32).view(-1)
+        spectrum = torch.fft.fft(kernel, n=height)[:, None] * torch.fft.rfft(kernel, n=width)[None, :]
+        FILTER_KERNELS.put(key, spectrum)
+    return spectrum
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def time_blur(latents: torch.Tensor, kernel_size: int, sigma: float, method: BLUR_METHODS, repeats: int = 3) -> float:
+    """Median seconds per gaussian_blur call with the given method, after one warmup call that fills the caches"""
+    gaussian_blur(latents, kernel_size, sigma, method)
+    times = []
+    for _ in range(repeats):
+        _synchronize(latents.device)
+        start = time.perf_counter()
+        gaussian_blur(latents, kernel_size, sigma, method)
+        _synchronize(latents.device)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def fastest_blur_method(latents: torch.Tensor, kernel_size: int, sigma: float) -> str:
+    """The faster of "conv" and "fft" for this kernel size and latent shape on this device, measured once"""
+    _, channels, height, width = latents.shape
+    key = (kernel_size, channels, height, width, str(latents.device), str(latents.dtype))
+    method = BLUR_METHOD_CHOICE.get(key)
+    if method is None:
+        conv_time = time_blur(latents, kernel_size, sigma, "conv")
+        fft_time = time_blur(latents, kernel_size, sigma, "fft")
+        method = "fft" if fft_time < conv_time else "conv"
+        BLUR_METHOD_CHOICE[key] = method
+        TRACE.debug("latent_filters", "kernel %d on %dx%d: conv %.3f ms, fft %.3f ms, using %s",
+                    kernel_size, height, width, conv_time * 1000, fft_time * 1000, method)
+    return method
+
+
+def gaussian_blur(latents: torch.Tensor, kernel_size: int, sigma: float, method: BLUR_METHODS = "auto") -> torch.Tensor:
+    """Gaussian blur of (B, C, H, W) latents with zero padding, same size out.
+    "conv" runs a horizontal and a vertical grouped conv (2k multiplies per pixel instead of k*k), "fft" multiplies
+    by the kernel spectrum, which costs the same for any kernel size. Both give the 2D conv2d result.
+    "auto" uses whichever was faster the first time this kernel size and latent shape came up on this device."""
+    if method == "auto":
+        method = fastest_blur_method(latents, kernel_size, sigma)
+    _, channels, height, width = latents.shape
+    pad = kernel_size // 2
+
+    if method == "fft":
+        # linear convolution: pad to the full output size so the circular wrap never overlaps the image
+        full_height, full_width = height + kernel_size - 1, width + kernel_size - 1
+        spectrum = torch.fft.rfft2(latents.float(), s=(full_height, full_width))
+        spectrum = spectrum * _gaussian_spectrum(kernel_size, sigma, full_height, full_width, latents.device)
+        blurred = torch.fft.irfft2(spectrum, s=(full_height, full_width))
+        return blurred[..., pad : pad + height, pad : pad + width].to(latents.dtype)
+
+    kernel = gaussian_kernel_1d(kernel_size, sigma, channels, latents.device, latents.dtype)
+    blurred = F.conv2d(latents, kernel.unsqueeze(2), padding=(0, pad), groups=channels)
+    blurred = F.conv2d(blurred, kernel.unsqueeze(3), padding=(pad, 0), groups=channels)
+    return blurred[..., :height, :width]
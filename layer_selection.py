@@ -0,0 +1,137 @@
+import fnmatch
+import math
+import re
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from diffusers import UNet2DConditionModel
+from invokeai.backend.util.logging import info, warning, error
+
+# named selections that can be used anywhere in a layer spec
+LAYER_PRESETS: dict[str, list[str]] = {
+    "all": ["*"],
+    "self-attn only": ["*.attn1.processor"],
+    "cross-attn only": ["*.attn2.processor"],
+    "down blocks only": ["down_blocks.*"],
+    "mid block only": ["mid_block.*"],
+    "up blocks only": ["up_blocks.*"],
+    "up block 0": ["up_blocks.0.*"],
+    "up block 0 cross-attn": ["up_blocks.0.*.attn2.processor"],
+}
+
+
+def execution_order(key: str) -> tuple:
+    """Sort key that puts attention processor names in the order the UNet runs them"""
+    blocks = key.split('.')
+    rank = {"down_blocks": 0, "mid_block": 1, "up_blocks": 2}.get(blocks[0], 3)
+    return (rank, *(int(b) if b.isdigit() else b for b in blocks[1:]))
+
+
+def _term_matcher(term: str):
+    if term.lower() in LAYER_PRESETS:
+        patterns = LAYER_PRESETS[term.lower()]
+        return lambda key: any(fnmatch.fnmatchcase(key, p) for p in patterns)
+    if term.startswith("re:"):
+        try:
+            regex = re.compile(term[3:])
+        except re.error as e:
+            raise ValueError(f"Invalid regex in layer spec '{term}': {e}")
+        return lambda key: regex.search(key) is not None
+    # globs may leave off the trailing '.processor'
+    return lambda key: fnmatch.fnmatchcase(key, term) or fnmatch.fnmatchcase(key.removesuffix(".processor"), term)
+
+
+def select_layers(keys: Iterable[str], spec: str) -> list[str]:
+    """Pick attention processor keys with a layer spec.
+
+    A spec is a comma, semicolon or newline separated list of terms, applied in order:
+        - a preset name from LAYER_PRESETS, e.g. "self-attn only"
+        - a glob over keys like 'up_blocks.0.attentions.2.transformer_blocks.0.attn1.processor', e.g. "up_blocks.0.*attn2"
+        - a regex prefixed with "re:", e.g. "re:up_blocks\\.[01]\\..*attn1"
+    Terms prefixed with "!" remove matching keys instead of adding them. A spec that starts with a removal
+    is applied on top of "all".
+    """
+    keys = list(keys)
+    terms = [t.strip() for t in re.split(r"[,;\n]", spec or "") if t.strip()]
+    if not terms:
+        return []
+    selected = set() if not terms[0].startswith("!") else set(keys)
+    for term in terms:
+        exclude = term.startswith("!")
+        matcher = _term_matcher(term[1:].strip() if exclude else term)
+        matched = {k for k in keys if matcher(k)}
+        if not matched:
+            warning(f"Layer spec term '{term}' did not match any attention layers")
+        selected = selected - matched if exclude else selected | matched
+    return [k for k in keys if k in selected]
+
+
+@dataclass
+class LayerCost:
+    key: str
+    heads: int
+    query_tokens: int
+    key_tokens: int
+    inner_dim: int
+    kv_bytes: int # stored keys + values
+    attention_map_bytes: int # stored softmax(QK^T)
+    extra_flops: int # one more attention over the stored keys/values
+
+
+def estimate_layer_costs(
+    unet: UNet2DConditionModel,
+    keys: Iterable[str],
+    latent_height: int,
+    latent_width: int,
+    batch_size: int = 2,
+    bytes_per_element: int = 2,
+    text_tokens: int = 77,
+) -> list[LayerCost]:
+    """Estimate the extra memory and compute of running a custom attention on each layer.
+    batch_size is 2 for a normal uncond + cond pass."""
+    num_levels = len(unet.config.block_out_channels)
+    costs = []
+    for key in keys:
+        attn = unet.get_submodule(key.rsplit('.', 1)[0])
+        blocks = key.split('.')
+        if blocks[0] == "down_blocks":
+            level = int(blocks[1])
+        elif blocks[0] == "up_blocks":
+            level = num_levels - 1 - int(blocks[1])
+        else:
+            level = num_levels - 1
+        scale = 2 ** level
+        query_tokens = math.ceil(latent_height / scale) * math.ceil(latent_width / scale)
+        key_tokens = text_tokens if attn.is_cross_attention else query_tokens
+        inner_dim = attn.to_k.out_features
+        costs.append(LayerCost(
+            key=key,
+            heads=attn.heads,
+            query_tokens=query_tokens,
+            key_tokens=key_tokens,
+            inner_dim=inner_dim,
+            kv_bytes=2 * batch_size * key_tokens * inner_dim * bytes_per_element,
+            attention_map_bytes=batch_size * attn.heads * query_tokens * key_tokens * bytes_per_element,
+            extra_flops=4 * batch_size * query_tokens * key_tokens * inner_dim,
+        ))
+    return costs
+
+
+def format_cost_report(selected: list[LayerCost], available: Optional[list[LayerCost]] = None) -> str:
+    """Per layer cost table, plus totals compared against all available layers"""
+    lines = [
+        f"{c.key}: q={c.query_tokens} k={c.key_tokens} kv={c.kv_bytes / 2**20:.1f}MB "
+        f"map={c.attention_map_bytes / 2**20:.1f}MB attn={c.extra_flops / 1e9:.2f}GFLOP"
+        for c in selected
+    ]
+
+    def totals(costs: list[LayerCost]) -> str:
+        kv = sum(c.kv_bytes for c in costs) / 2**20
+        maps = sum(c.attention_map_bytes for c in costs) / 2**20
+        flops = sum(c.extra_flops for c in costs) / 1e9
+        return f"{len(costs)} layers, kv={kv:.1f}MB map={maps:.1f}MB attn={flops:.2f}GFLOP"
+
+    lines.append(f"selected: {totals(selected)}")
+    if available is not None:
+        lines.append(f"all layers: {totals(available)}")
+    return "\n".join(lines)
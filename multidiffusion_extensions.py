@@ -0,0 +1,342 @@
+####################################################################################################
+# MultiDiffusion Sampling
+# From: https://multidiffusion.github.io/
+####################################################################################################
+import math
+import random
+from typing import Any, Callable, Literal, Optional
+
+import torch
+import torch.nn.functional as F
+from invokeai.app.invocations.baseinvocation import BaseInvocation, invocation
+from invokeai.app.invocations.fields import InputField
+from invokeai.app.services.shared.invocation_context import InvocationContext
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext
+from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
+from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase, callback
+from invokeai.backend.util.logging import info, warning, error
+
+from .cache_utils import TensorLRUCache
+from .debug_trace import TRACE
+from .extension_classes import GuidanceDataOutput, GuidanceField, base_guidance_extension, wrap_unet_forward
+
+MD_PAD_MODES = Literal[
+    "constant",
+    "reflect",
+    "replicate",
+]
+TILE_BLEND_MODES = Literal["gaussian", "uniform"]
+
+View = tuple[int, int, int, int] # h_start, h_end, w_start, w_end
+
+
+def get_views(height: int, width: int, window_size: int = 128, stride: int = 64, random_jitter: bool = False) -> list[View]:
+    """Tiles covering a (height, width) latent, the last row/column shifted back to end at the edge.
+    With random_jitter, the views are for a latent padded by (window_size - stride) // 4 on every side.
+    A side shorter than window_size gets a single view of its full length, so the views can be non-square but all
+    have the same size."""
+    window_height, window_width = min(window_size, height), min(window_size, width)
+    # Here, we define the mappings F_i (see Eq. 7 in the MultiDiffusion paper https://arxiv.org/abs/2302.08113)
+    # if panorama's height/width < window_size, num_blocks of height/width should return 1
+    num_blocks_height = int((height - window_height) / stride - 1e-6) + 2 if height > window_height else 1
+    num_blocks_width = int((width - window_width) / stride - 1e-6) + 2 if width > window_width else 1
+    total_num_blocks = int(num_blocks_height * num_blocks_width)
+    views = []
+    for i in range(total_num_blocks):
+        h_start = int((i // num_blocks_width) * stride)
+        h_end = h_start + window_height
+        w_start = int((i % num_blocks_width) * stride)
+        w_end = w_start + window_width
+
+        if h_end > height:
+            h_start = int(h_start + height - h_end)
+            h_end = int(height)
+        if w_end > width:
+            w_start = int(w_start + width - w_end)
+            w_end = int(width)
+        if h_start < 0:
+            h_end = int(h_end - h_start)
+            h_start = 0
+        if w_start < 0:
+            w_end = int(w_end - w_start)
+            w_start = 0
+
+        if random_jitter:
+            jitter_range = (window_size - stride) // 4
+            w_jitter = 0
+            h_jitter = 0
+            if (w_start != 0) and (w_end != width):
+                w_jitter = random.randint(-jitter_range, jitter_range)
+            elif (w_start == 0) and (w_end != width):
+                w_jitter = random.randint(-jitter_range, 0)
+            elif (w_start != 0) and (w_end == width):
+                w_jitter = random.randint(0, jitter_range)
+            if (h_start != 0) and (h_end != height):
+                h_jitter = random.randint(-jitter_range, jitter_range)
+            elif (h_start == 0) and (h_end != height):
+                h_jitter = random.randint(-jitter_range, 0)
+            elif (h_start != 0) and (h_end == height):
+                h_jitter = random.randint(0, jitter_range)
+            h_start += (h_jitter + jitter_range)
+            h_end += (h_jitter + jitter_range)
+            w_start += (w_jitter + jitter_range)
+            w_end += (w_jitter + jitter_range)
+
+        views.append((int(h_start), int(h_end), int(w_start), int(w_end)))
+    return views
+
+
+def uses_ip_adapter(unet: torch.nn.Module) -> bool:
+    """Whether IP-Adapter weights are patched into the UNet's attention processors. Their image embeddings and
+    masks are built for the full batch and latent, so they don't fit tiles or dilated subsamples."""
+    return any(getattr(p, "_ip_adapter_attention_weights", None) for p in unet.attn_processors.values())
+
+
+def tile_weights(height: int, width: int, blend: TILE_BLEND_MODES, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """(height, width) weight of each pixel of a tile's prediction. Gaussian weights fall off toward the tile edges,
+    so overlaps cross-fade instead of showing the seams a flat average leaves."""
+    if blend == "uniform":
+        return torch.ones((height, width), device=device, dtype=dtype)
+
+    def falloff(size: int) -> torch.Tensor:
+        x = torch.arange(size, device=device, dtype=torch.float32)
+        midpoint = (size - 1) / 2
+        sigma = size / 4
+        return torch.exp(-((x - midpoint) ** 2) / (2 * sigma ** 2))
+
+    return (falloff(height)[:, None] * falloff(width)[None, :]).to(dtype)
+
+
+def _slice_residual(residual: torch.Tensor, view: View, latent_height: int) -> torch.Tensor:
+    """The part of a full-size ControlNet/T2I residual that lines up with a tile.
+    Residuals come at the latent size divided by a power of two, sliced to the size the UNet produces for the tile."""
+    factor = 2 ** round(math.log2(latent_height / residual.shape[-2]))
+    h_start, h_end, w_start, w_end = view
+    h_len = math.ceil((h_end - h_start) / factor)
+    w_len = math.ceil((w_end - w_start) / factor)
+    h0 = min(h_start // factor, residual.shape[-2] - h_len)
+    w0 = min(w_start // factor, residual.shape[-1] - w_len)
+    return residual[..., h0 : h0 + h_len, w0 : w0 + w_len]
+
+
+def repeat_batch_kwargs(kwargs: dict[str, Any], n: int) -> dict[str, Any]:
+    """UNet kwargs for a sample made of n copies of the batch stacked along the batch dimension:
+    per-sample inputs (timesteps, text embeddings, SDXL added conditions) are repeated n times."""
+    stacked = dict(kwargs)
+
+    def repeat(t: torch.Tensor) -> torch.Tensor:
+        return t.repeat(n, *([1] * (t.dim() - 1)))
+
+    timestep = kwargs.get("timestep")
+    if isinstance(timestep, torch.Tensor) and timestep.dim() > 0 and timestep.numel() > 1:
+        stacked["timestep"] = repeat(timestep)
+    for name in ("encoder_hidden_states", "encoder_attention_mask"):
+        if kwargs.get(name) is not None:
+            stacked[name] = repeat(kwargs[name])
+    if kwargs.get("added_cond_kwargs") is not None:
+        stacked["added_cond_kwargs"] = {k: repeat(v) for k, v in kwargs["added_cond_kwargs"].items()}
+    return stacked
+
+
+def _stack_tile_kwargs(kwargs: dict[str, Any], views: list[View], latent_height: int) -> dict[str, Any]:
+    """UNet kwargs for a batch of tiles: per-sample inputs repeated per tile, spatial residuals sliced per tile."""
+    stacked = repeat_batch_kwargs(kwargs, len(views))
+    for name in ("down_block_additional_residuals", "down_intrablock_additional_residuals"):
+        if kwargs.get(name) is not None:
+            stacked[name] = tuple(
+                torch.cat([_slice_residual(r, view, latent_height) for view in views]) for r in kwargs[name]
+            )
+    if kwargs.get("mid_block_additional_residual") is not None:
+        r = kwargs["mid_block_additional_residual"]
+        stacked["mid_block_additional_residual"] = torch.cat([_slice_residual(r, view, latent_height) for view in views])
+    return stacked
+
+
+# (normalized weights, flat pixel indices) per tile layout. Jittered views change every step, so bound it by bytes.
+TILE_PLANS = TensorLRUCache(max_bytes=64 * 2**20)
+
+
+def tile_plan(height: int, width: int, views: list[View], blend: TILE_BLEND_MODES, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    """Per-tile weights already divided by the total weight at each pixel, and the flat index of each tile pixel in
+    the (height * width) latent. Built once per latent size and tile layout, not per step.
+    The views must all have the same size, as the ones from get_views do, so both come back as (tiles, tile_pixels)."""
+    key = (height, width, tuple(views), blend, str(device))
+    plan = TILE_PLANS.get(key)
+    if plan is not None:
+        return plan
+
+    if len({(h1 - h0, w1 - w0) for h0, h1, w0, w1 in views}) > 1:
+        raise ValueError(f"Tiles must all be the same size, got {views}")
+    if any(h0 < 0 or w0 < 0 or h1 > height or w1 > width for h0, h1, w0, w1 in views):
+        raise ValueError(f"Tiles must fit in the {height}x{width} latent, got {views}")
+    rows = torch.arange(height * width, device=device).view(height, width)
+    index = torch.stack([rows[h0:h1, w0:w1].reshape(-1) for h0, h1, w0, w1 in views])
+    h0, h1, w0, w1 = views[0]
+    weights = tile_weights(h1 - h0, w1 - w0, blend, device, torch.float32).reshape(1, -1).expand(len(views), -1)
+    total = torch.zeros(height * width, device=device, dtype=torch.float32)
+    total.index_add_(0, index.reshape(-1), weights.reshape(-1))
+    weights = weights / total.clamp(min=1e-8)[index]
+    plan = (weights.contiguous(), index)
+    TILE_PLANS.put(key, plan)
+    return plan
+
+
+def tiled_unet_forward(
+    default: Callable[..., torch.Tensor],
+    sample: torch.Tensor,
+    views: list[View],
+    tile_batch_size: int = 1,
+    blend: TILE_BLEND_MODES = "gaussian",
+    **kwargs,
+) -> torch.Tensor:
+    """Run the UNet over views of `sample`, tile_batch_size tiles per forward, and blend the overlapping
+    predictions with per-tile weights.
+    Tiles are gathered with one index_select per batch of tiles and scattered back with one index_add_ into a single
+    flat accumulator; the weights are pre-normalized, so there is no count map and no division."""
+    batch, channels, height, width = sample.shape
+    h0, h1, w0, w1 = views[0]
+    tile_h, tile_w = h1 - h0, w1 - w0
+    weights, index = tile_plan(height, width, views, blend, sample.device)
+
+    flat_sample = sample.reshape(batch, channels, height * width)
+    output = None
+    tile_batch_size = max(tile_batch_size, 1)
+    for first in range(0, len(views), tile_batch_size):
+        group = views[first : first + tile_batch_size]
+        n = len(group)
+        group_index = index[first : first + n].reshape(-1)
+        # (batch, C, n * pixels) -> (n * batch, C, tile_h, tile_w), tile major like the stacked kwargs
+        tiles = flat_sample.index_select(2, group_index).view(batch, channels, n, tile_h, tile_w)
+        tiles = tiles.permute(2, 0, 1, 3, 4).reshape(n * batch, channels, tile_h, tile_w)
+        noise_pred = default(sample=tiles, **_stack_tile_kwargs(kwargs, group, height))
+
+        out_channels = noise_pred.shape[1]
+        if output is None:
+            output = torch.zeros((batch, out_channels, height * width), device=sample.device, dtype=torch.float32)
+        weighted = noise_pred.float().view(n, batch, out_channels, tile_h * tile_w) * weights[first : first + n, None, None, :]
+        output.index_add_(2, group_index, weighted.permute(1, 2, 0, 3).reshape(batch, out_channels, -1))
+    return output.view(batch, -1, height, width).to(sample.dtype)
+
+
+@base_guidance_extension("TiledDenoise")
+class TiledDenoiseGuidance(ExtensionBase):
+    """
+    Splits each UNet call into overlapping tiles of the latent, so latents far larger than the UNet fits in memory
+    can be denoised. Everything else in the step (CFG, scheduler, other extensions) sees the full latent.
+    """
+    def __init__(
+        self,
+        context: InvocationContext,
+        tile_size: int,
+        stride: int,
+        tile_batch_size: int = 1,
+        blend: TILE_BLEND_MODES = "gaussian",
+        jitter: bool = False,
+        pad_mode: MD_PAD_MODES = "reflect",
+    ):
+        self.window_size = tile_size // 8
+        self.stride = stride // 8
+        self.tile_batch_size = tile_batch_size
+        self.blend = blend
+        self.jitter = jitter
+        self.pad_mode = pad_mode
+        self.restore_unet_forward: Optional[Callable[[], None]] = None
+        super().__init__()
+
+    @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
+    def pre_denoise_loop(self, ctx: DenoiseContext):
+        conditioning = ctx.inputs.conditioning_data
+        if conditioning.cond_regions is not None or conditioning.uncond_regions is not None:
+            raise ValueError("Tiled denoise does not support regional prompts")
+        if uses_ip_adapter(ctx.unet):
+            raise ValueError("Tiled denoise does not support IP-Adapter")
+        self.restore_unet_forward = wrap_unet_forward(ctx.sd_backend, self.unet_forward)
+
+    def unet_forward(self, default, sample: torch.Tensor, **kwargs) -> torch.Tensor:
+        height, width = sample.shape[-2:]
+        views = get_views(height, width, self.window_size, self.stride, self.jitter)
+        jitter_range = (self.window_size - self.stride) // 4 if self.jitter else 0
+        if jitter_range > 0:
+            sample = F.pad(sample, (jitter_range, jitter_range, jitter_range, jitter_range), self.pad_mode, 0)
+            # residuals line up with the unpadded latent, so jittered tiles can't use them
+            for name in ("down_block_additional_residuals", "mid_block_additional_residual", "down_intrablock_additional_residuals"):
+                if kwargs.get(name) is not None:
+                    kwargs[name] = None
+                    TRACE.debug("TiledDenoise", "dropped %s, not supported with jitter", name)
+        if TRACE.tracing:
+            TRACE.event("TiledDenoise", "%d views over %dx%d", len(views), height, width)
+
+        noise_pred = tiled_unet_forward(default, sample, views, self.tile_batch_size, self.blend, **kwargs)
+
+        #crop the padding back off
+        if jitter_range > 0:
+            noise_pred = noise_pred[:, :, jitter_range:-jitter_range, jitter_range:-jitter_range]
+        return noise_pred
+
+    @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
+    def post_denoise_loop(self, ctx: DenoiseContext):
+        if self.restore_unet_forward is not None:
+            self.restore_unet_forward()
+            self.restore_unet_forward = None
+
+
+@invocation(
+    "tiled_denoise_extInvocation",
+    title="MultiDiffusion Tiled Denoise [Extension]",
+    tags=["tiled", "multidiffusion", "denoise", "extension"],
+    category="latents",
+    version="1.0.0",
+)
+class TiledDenoise_ExtensionInvocation(BaseInvocation):
+    """Reduces VRAM usage by splitting large latents into overlapping tiles for every UNet call."""
+    tile_size: int = InputField(
+        title="Tile Size",
+        description="Size of each tile in pixels.",
+        default=1024,
+        ge=128,
+        multiple_of=64,
+    )
+    stride: int = InputField(
+        title="Stride",
+        description="Distance from the start of each tile to the next in pixels. Smaller than the tile size to overlap them.",
+        default=768,
+        ge=64,
+        multiple_of=64,
+    )
+    tile_batch_size: int = InputField(
+        title="Tile Batch Size",
+        description="How many tiles go through the UNet in one call. Higher is faster until memory runs out.",
+        default=1,
+        ge=1,
+    )
+    blend: TILE_BLEND_MODES = InputField(
+        title="Blend",
+        description="How overlapping tiles are combined. Gaussian fades each tile out toward its edges, uniform averages them.",
+        default="gaussian",
+    )
+    jitter: bool = InputField(
+        title="Jitter",
+        description="Randomly shift the tiles every step to hide seams. May require higher step counts. ControlNet/T2I residuals are not applied with jitter.",
+        default=False,
+    )
+    pad_mode: MD_PAD_MODES = InputField(
+        title="Pad Mode",
+        description="Padding for the edges of the latent. Only used with jitter.",
+        default="reflect",
+    )
+
+    def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
+        kwargs = {
+            "tile_size": self.tile_size,
+            "stride": self.stride,
+            "tile_batch_size": self.tile_batch_size,
+            "blend": self.blend,
+            "jitter": self.jitter,
+            "pad_mode": self.pad_mode,
+        }
+        return GuidanceDataOutput(
+            guidance_data_output=GuidanceField(
+                guidance_name="TiledDenoise",
+                extension_kwargs=kwargs
+            )
+        )
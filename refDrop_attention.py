@@ -6,8 +6,29 @@ from torchvision.transforms.functional import resize as tv_resize
 from diffusers.models.attention_processor import Attention, AttnProcessor2_0
 from invokeai.backend.stable_diffusion.diffusion.regional_prompt_data import RegionalPromptData
 from invokeai.backend.stable_diffusion.diffusion.regional_ip_data import RegionalIPData
-from typing import List, Optional, cast
+from typing import List, Literal, Optional, cast
+from dataclasses import dataclass
 import math
+from .debug_trace import TRACE
+from .attention_ops import quantize_int8, pool_tokens, paired_attention
+
+REFERENCE_STORAGE_DTYPES = Literal["native", "fp16", "bf16", "int8"]
+
+
+@dataclass
+class ReferenceStoragePolicy:
+    """How the saved reference keys/values are held between the reference pass and the blend"""
+    dtype: REFERENCE_STORAGE_DTYPES = "native"
+    token_pool: int = 1 # average pool self-attention keys/values spatially by this factor
+    offload: bool = False # keep on the CPU in pinned memory, prefetched to the device one processor ahead
+
+
+_prefetch_streams: dict[torch.device, "torch.cuda.Stream"] = {}
+
+def _prefetch_stream(device: torch.device) -> "torch.cuda.Stream":
+    if device not in _prefetch_streams:
+        _prefetch_streams[device] = torch.cuda.Stream(device=device)
+    return _prefetch_streams[device]
 
 
 class StoreAttentionModulation(CustomAttnProcessor2_0):
@@ -16,8 +37,120 @@ class StoreAttentionModulation(CustomAttnProcessor2_0):
         self.C = C
         self.store_copy: bool = False
         self.attn_name = ""
+        self.saved_key: Optional[torch.Tensor] = None
+        self.saved_value: Optional[torch.Tensor] = None
+        # number of trailing batch entries that belong to the reference when it is batched into the main pass
+        self.reference_batch_size: int = 0
+        # keep the reference keys and values from a batched call so they can be cached
+        self.keep_reference: bool = False
+        self.storage_policy = ReferenceStoragePolicy()
+        self.latent_size: tuple[int, int] = (0, 0) # needed to recover the token layout for pooling
+        self.saved_scales: Optional[tuple[torch.Tensor, torch.Tensor]] = None
+        self.next_processor: Optional["StoreAttentionModulation"] = None # next one to run, for prefetching
+        self._prefetched = None
+        self.stacked_blend: bool = False # own and reference attention in one call
         super().__init__(*args, **kwargs)
 
+    def store_reference(self, key: torch.Tensor, value: torch.Tensor, pool: bool):
+        """Keep the reference keys/values in the form given by the storage policy.
+        `pool` should be False for cross-attention, and for keys/values that were already pooled."""
+        policy = self.storage_policy
+        if policy.token_pool > 1 and pool:
+            key = pool_tokens(key, self.latent_size, policy.token_pool)
+            value = pool_tokens(value, self.latent_size, policy.token_pool)
+
+        self.saved_scales = None
+        if policy.dtype == "int8":
+            key, key_scale = quantize_int8(key)
+            value, value_scale = quantize_int8(value)
+            self.saved_scales = (key_scale, value_scale)
+        elif policy.dtype == "fp16":
+            key, value = key.half(), value.half()
+        elif policy.dtype == "bf16":
+            key, value = key.to(torch.bfloat16), value.to(torch.bfloat16)
+
+        if policy.offload:
+            key, value = self._to_host(key), self._to_host(value)
+            if self.saved_scales is not None:
+                self.saved_scales = tuple(self._to_host(s) for s in self.saved_scales)
+        self.saved_key = key
+        self.saved_value = value
+        self._prefetched = None
+
+    @staticmethod
+    def _to_host(tensor: torch.Tensor) -> torch.Tensor:
+        tensor = tensor.to("cpu")
+        return tensor.pin_memory() if torch.cuda.is_available() else tensor
+
+    def reference_state(self) -> tuple:
+        return (self.saved_key, self.saved_value, self.saved_scales)
+
+    def set_reference_state(self, state: tuple, device: torch.device):
+        """Restore a state from reference_state(), placed on `device` or the host as the policy says"""
+        key, value, scales = state
+        place = self._to_host if self.storage_policy.offload else (lambda t: t.to(device, non_blocking=True))
+        self.saved_key, self.saved_value = place(key), place(value)
+        self.saved_scales = None if scales is None else tuple(place(t) for t in scales)
+        self._prefetched = None
+
+    @staticmethod
+    def _dequantize(state: tuple, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+        key, value, scales = state
+        key, value = key.to(device), value.to(device)
+        if scales is not None:
+            key = key.to(scales[0].dtype) * scales[0].to(device)
+            value = value.to(scales[1].dtype) * scales[1].to(device)
+        return key, value
+
+    def interpolate_reference(self, state_a: tuple, state_b: tuple, weight: float, device: torch.device):
+        """Set the reference to a linear interpolation between two reference_state()s"""
+        key_a, value_a = self._dequantize(state_a, device)
+        key_b, value_b = self._dequantize(state_b, device)
+        self.store_reference(torch.lerp(key_a, key_b, weight), torch.lerp(value_a, value_b, weight), pool=False)
+
+    def reference_nbytes(self) -> int:
+        tensors = [self.saved_key, self.saved_value, *(self.saved_scales or ())]
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+    def clear_reference(self):
+        self.saved_key = None
+        self.saved_value = None
+        self.saved_scales = None
+        self._prefetched = None
+
+    def prefetch(self, device: torch.device):
+        """Start copying the offloaded reference to the device on a side stream"""
+        if self.saved_key is None or self._prefetched is not None or self.saved_key.device == device:
+            return
+        tensors = [self.saved_key, self.saved_value, *(self.saved_scales or ())]
+        if device.type == "cuda":
+            stream = _prefetch_stream(device)
+            with torch.cuda.stream(stream):
+                self._prefetched = [t.to(device, non_blocking=True) for t in tensors]
+        else:
+            self._prefetched = [t.to(device) for t in tensors]
+
+    def reference_kv(self, query: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """The saved reference keys/values, on the device and in the dtype of `query`"""
+        self.prefetch(query.device)
+        if self._prefetched is not None:
+            if query.device.type == "cuda":
+                torch.cuda.current_stream(query.device).wait_stream(_prefetch_stream(query.device))
+                for t in self._prefetched:
+                    t.record_stream(torch.cuda.current_stream(query.device))
+            key, value, *scales = self._prefetched
+            self._prefetched = None
+        else:
+            key, value, *scales = [self.saved_key, self.saved_value, *(self.saved_scales or ())]
+
+        if self.next_processor is not None:
+            self.next_processor.prefetch(query.device)
+
+        if scales:
+            key = key.float() * scales[0].float()
+            value = value.float() * scales[1].float()
+        return key.to(query.dtype), value.to(query.dtype)
+
     @torch.no_grad()
     def __call__(
         self,
@@ -105,19 +238,35 @@ class StoreAttentionModulation(CustomAttnProcessor2_0):
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-        )
-
-        if self.store_copy:
+        ref_attention = None # (query, key, value, mask) to blend in from the reference
+        if self.reference_batch_size > 0:
+            # the reference rides along at the end of the batch, so its keys and values come from this same call
+            ref = self.reference_batch_size
+            if self.keep_reference:
+                self.store_reference(key[-ref:], value[-ref:], pool=not is_cross_attention)
+            if not self.store_copy:
+                ref_mask = None if attention_mask is None else attention_mask[:-ref]
+                ref_attention = (query[:-ref], key[-ref:], value[-ref:], ref_mask)
+        elif self.store_copy:
             #self.saved_query = query
-            self.saved_key = key
-            self.saved_value = value
+            self.store_reference(key, value, pool=not is_cross_attention)
+        elif self.saved_key is not None:
+            saved_key, saved_value = self.reference_kv(query)
+            ref_mask = attention_mask
+            if ref_mask is not None and ref_mask.shape[-1] != saved_key.shape[-2]:
+                ref_mask = None # keys were pooled, the mask no longer lines up
+            ref_attention = (query, saved_key, saved_value, ref_mask)
+
+        if ref_attention is None:
+            hidden_states = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+            )
         else:
-            hidden_states_ref = F.scaled_dot_product_attention(
-                query, self.saved_key, self.saved_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+            hidden_states, hidden_states_ref = paired_attention(
+                (query, key, value, attention_mask), ref_attention, stacked=self.stacked_blend
             )
-            hidden_states = self.C * hidden_states_ref + (1 - self.C)*hidden_states
+            rows = hidden_states_ref.shape[0]
+            hidden_states[:rows] = self.C * hidden_states_ref + (1 - self.C)*hidden_states[:rows]
 
 
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
@@ -201,5 +350,8 @@ class StoreAttentionModulation(CustomAttnProcessor2_0):
         # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
         # End of unmodified block from AttnProcessor2_0
 
+        if TRACE.tracing:
+            TRACE.event("RefDrop", "%s %s query=%d", self.attn_name, "store" if self.store_copy else "blend", query_seq_len)
+
         # casting torch.Tensor to torch.FloatTensor to avoid type issues
         return cast(torch.FloatTensor, hidden_states)
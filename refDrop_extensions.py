@@ -26,19 +26,31 @@ from invokeai.app.invocations.fields import (
 from invokeai.app.invocations.denoise_latents import DenoiseLatentsInvocation
 
 import torch
-from .extension_classes import GuidanceField, base_guidance_extension, GuidanceDataOutput
+from .extension_classes import GuidanceField, base_guidance_extension, GuidanceDataOutput, wrap_unet_forward, scale_model_input_at
 from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase, callback
 from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
-from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext, UNetKwargs
 from invokeai.backend.util.logging import info, warning, error
 import random
 import einops
 from diffusers import UNet2DConditionModel
-from typing import Type, Any, Dict, Iterator, List, Optional, Tuple, Union
-from .refDrop_attention import StoreAttentionModulation
+from typing import Type, Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
+from .refDrop_attention import StoreAttentionModulation, ReferenceStoragePolicy, REFERENCE_STORAGE_DTYPES
+from .debug_trace import TRACE
+from .fam_extensions import reference_noise
+from .cache_utils import LOADED_TENSORS, TensorLRUCache, hash_tensors, cached_conditioning_data, cached_tensor
+from .layer_selection import LAYER_PRESETS, select_layers, estimate_layer_costs, format_cost_report, execution_order
 from invokeai.backend.stable_diffusion.extensions_manager import ExtensionsManager
 from invokeai.backend.stable_diffusion.diffusion.conditioning_data import ConditioningMode
 
+# reference keys/values per timestep, shared by every RefDrop run in this process. Held on the CPU.
+REFERENCE_KV_CACHE = TensorLRUCache(max_bytes=0)
+
+# called with a dict describing the memory used by each run, for comparing storage policies
+REFDROP_MEMORY_HOOKS: list[Callable[[dict[str, Any]], None]] = []
+
+def register_memory_hook(hook: Callable[[dict[str, Any]], None]):
+    REFDROP_MEMORY_HOOKS.append(hook)
 
 def patch_unet_attention_processor(unet: UNet2DConditionModel, processor_cls: Type[Any]):
     """A context manager that patches `unet` with the provided attention processor.
@@ -71,16 +83,45 @@ class RefDrop_Guidance(ExtensionBase):
         positive_conditioning: Union[ConditioningField, list[ConditioningField]],
         negative_conditioning: Union[ConditioningField, list[ConditioningField]],
         stop_at: float,
-        once_and_only_once: bool
+        once_and_only_once: bool,
+        batched_reference: bool = False,
+        cache_reference: bool = False,
+        cache_budget_mb: int = 4096,
+        cache_spill_to_disk: bool = False,
+        storage_dtype: REFERENCE_STORAGE_DTYPES = "native",
+        token_pooling: int = 1,
+        offload_to_cpu: bool = False,
+        layer_selection: str = "all",
+        single_call_blend: bool = False,
+        keyframes: int = 0,
+        keyframe_schedule: Literal["uniform", "front_loaded"] = "uniform",
     ):
         self.C = C
-        self.initial_latents = context.tensors.load(latent_image_name)
+        self.latent_image_name = latent_image_name
+        self.initial_latents = cached_tensor(context, latent_image_name)
         self.skip_up_block_1 = skip_up_block_1
         self.skip_until = skip_until
         self.positive_conditioning = positive_conditioning
         self.negative_conditioning = negative_conditioning
         self.stop_at = stop_at
         self.once_and_only_once = once_and_only_once
+        self.batched_reference = batched_reference
+        self.reference_model_input = None
+        self.reference_batch_size = 0
+        self.cache_reference = cache_reference
+        self.cache_budget_mb = cache_budget_mb
+        self.cache_spill_to_disk = cache_spill_to_disk
+        self.storage_policy = ReferenceStoragePolicy(dtype=storage_dtype, token_pool=token_pooling, offload=offload_to_cpu)
+        self.peak_reference_bytes = 0
+        self.device_peak_baseline: Optional[int] = None
+        self.pending_cache_key = None
+        self.layer_selection = layer_selection
+        self.selected_layers: set[str] = set()
+        self.single_call_blend = single_call_blend
+        self.keyframes = keyframes
+        self.keyframe_schedule = keyframe_schedule
+        self.keyframe_steps: list[int] = []
+        self.keyframe_states: dict[int, dict[str, tuple]] = {}
         # self.noise = torch.randn(
         #     self.initial_latents.shape,
         #     dtype=torch.float32,
@@ -98,41 +139,63 @@ class RefDrop_Guidance(ExtensionBase):
             Setting all processors to use the custom attention makes the process take 2x longer
             It also requires an extra 12GB of GPU memory at SDXL 1024x1024 resolution just to hold coppies of the attention weights.
             The paper specifies that they only use it for the up_blocks, and that the most significant effect is up_block_0.
-            Since there is no published code, it's worth playing around with which ones are activated. Potentially allow a list of string inputs to specify block options.
+            Since there is no published code, it's worth playing around with which ones are activated; the layer selection spec picks them.
         """
         #key is in form 'up_blocks.0.attentions.2.transformer_blocks.0.attn1.processor'
-        blocks = key.split('.')
-        #print(key)
-        #if '.attn2.processor' in key:
-        #print(f"Custom attention for {key}")
-        #if not self.skip_up_block_1 or not 'up_blocks.0.attentions.0' in key: #skip the first up block
-        return True
+        return key in self.selected_layers
 
 
     @callback(ExtensionCallbackType.PRE_DENOISE_LOOP)
     def pre_denoise_loop(self, ctx: DenoiseContext):
 
-        self.noise = ctx.inputs.noise.clone()
+        # device copy from the shared cache, so the per-step .to(device) calls are free
+        self.initial_latents = cached_tensor(self.context, self.latent_image_name, ctx.latents.device)
+        # the denoise noise when the reference is the same size, otherwise seeded noise of the reference's size
+        self.noise = reference_noise(ctx, self.initial_latents.shape, None)
+        TRACE.debug("RefDrop", "loaded tensor cache %s", LOADED_TENSORS.stats())
 
         unet_replacement_processors = {}
         self.unet_new_processors = []
 
-        for key in ctx.unet.attn_processors.keys():
+        all_layers = list(ctx.unet.attn_processors.keys())
+        self.selected_layers = set(select_layers(all_layers, self.layer_selection))
+        info(f"RefDrop layer selection '{self.layer_selection}' cost:\n" + format_cost_report(
+            estimate_layer_costs(ctx.unet, [k for k in all_layers if k in self.selected_layers], *ctx.latents.shape[-2:]),
+            estimate_layer_costs(ctx.unet, all_layers, *ctx.latents.shape[-2:]),
+        ))
+
+        original_processors = ctx.unet.attn_processors
+        self.original_processors = {}
+        self.stopped = False
+        for key in all_layers:
             if self.is_custom_attention(key):
+                self.original_processors[key] = original_processors[key]
                 unet_replacement_processors[key] = StoreAttentionModulation(self.C)
                 self.unet_new_processors.append(unet_replacement_processors[key])
                 unet_replacement_processors[key].attn_name = key
+                unet_replacement_processors[key].storage_policy = self.storage_policy
+                unet_replacement_processors[key].latent_size = tuple(ctx.latents.shape[-2:])
+                unet_replacement_processors[key].stacked_blend = self.single_call_blend
                 #print(f"added custom attention for {key}")
             else:
-                unet_replacement_processors[key] = ctx.unet.attn_processors[key]
+                unet_replacement_processors[key] = original_processors[key]
 
         ctx.unet.set_attn_processor(unet_replacement_processors)
 
+        # chain the processors in the order they run, so each can prefetch its successor's offloaded reference
+        self.unet_new_processors.sort(key=lambda p: execution_order(p.attn_name))
+        for attn_processor, next_processor in zip(self.unet_new_processors, self.unet_new_processors[1:]):
+            attn_processor.next_processor = next_processor
+
+        self.peak_reference_bytes = 0
+        # the peak counter is process-wide and other nodes read it too, so compare against it instead of resetting it
+        self.device_peak_baseline = torch.cuda.max_memory_allocated() if ctx.latents.device.type == "cuda" else None
+
         if self.positive_conditioning is None or self.negative_conditioning is None:
             info("At least one of the conditioning fields is None. Using the conditioning data from the context instead.")
             self.ref_conditioning = ctx.inputs.conditioning_data
         else:
-            self.ref_conditioning: TextConditioningData = DenoiseLatentsInvocation.get_conditioning_data(
+            self.ref_conditioning: TextConditioningData = cached_conditioning_data(
                 context = self.context,
                 positive_conditioning_field=self.positive_conditioning,
                 negative_conditioning_field=self.negative_conditioning,
@@ -145,10 +208,100 @@ class RefDrop_Guidance(ExtensionBase):
                 cfg_rescale_multiplier=0,
             )
 
-    
+        self.restore_unet_forward = None
+        if self.batched_reference:
+            self.restore_unet_forward = wrap_unet_forward(ctx.sd_backend, self.unet_forward)
+
+        self.keyframe_states = {}
+        self.keyframe_steps = []
+        if self.keyframes > 0 and not self.once_and_only_once:
+            self.keyframe_steps = self.choose_keyframe_steps(ctx.inputs.timesteps, ctx.scheduler.config.num_train_timesteps)
+            info(f"RefDrop reference keyframes at steps {self.keyframe_steps}")
+
+        if self.cache_reference:
+            REFERENCE_KV_CACHE.configure(self.cache_budget_mb * 2**20, self.cache_spill_to_disk)
+            self.cache_key = self.reference_cache_key(ctx)
+
+    def reference_cache_key(self, ctx: DenoiseContext) -> tuple:
+        """Everything the reference keys/values depend on, except for the timestep"""
+        if self.positive_conditioning is None or self.negative_conditioning is None:
+            conditioning_tensors = []
+            for c in [self.ref_conditioning.uncond_text, self.ref_conditioning.cond_text]:
+                conditioning_tensors.append(c.embeds)
+                if isinstance(c, SDXLConditioningInfo):
+                    conditioning_tensors.extend([c.pooled_embeds, c.add_time_ids])
+            conditioning_id = hash_tensors(*conditioning_tensors)
+        else:
+            conditioning_id = repr((self.positive_conditioning, self.negative_conditioning))
+
+        scheduler_id = (type(ctx.scheduler).__name__, repr(sorted(ctx.scheduler.config.items())))
+
+        # LoRAs and other weight patches change the keys/values, so hash the projections that produce them
+        projections = []
+        for attn_processor in self.unet_new_processors:
+            attn = ctx.unet.get_submodule(attn_processor.attn_name.rsplit('.', 1)[0])
+            projections.extend([attn.to_k.weight, attn.to_v.weight])
+        unet_id = hash_tensors(*projections)
+
+        layers_id = hash(tuple(p.attn_name for p in self.unet_new_processors))
+        return (
+            self.latent_image_name,
+            # the seed is 0 whenever the noise field has none, the noise itself is what the reference depends on
+            hash_tensors(self.noise),
+            conditioning_id,
+            scheduler_id,
+            unet_id,
+            layers_id,
+            str(ctx.latents.dtype),
+            repr(self.storage_policy),
+        )
+
+    def step_cache_key(self, ctx: DenoiseContext) -> tuple:
+        return self.cache_key + (round(ctx.timestep.item(), 4),)
+
+    def load_cached_reference(self, ctx: DenoiseContext, key: tuple) -> bool:
+        cached = REFERENCE_KV_CACHE.get(key)
+        if cached is None:
+            return False
+        for attn_processor in self.unet_new_processors:
+            attn_processor.set_reference_state(cached[attn_processor.attn_name], ctx.latents.device)
+        return True
+
+    def store_cached_reference(self, key: tuple):
+        REFERENCE_KV_CACHE.put(key, {
+            p.attn_name: (
+                p.saved_key.to("cpu"),
+                p.saved_value.to("cpu"),
+                None if p.saved_scales is None else tuple(t.to("cpu") for t in p.saved_scales),
+            )
+            for p in self.unet_new_processors
+        })
+
+    def can_batch_reference(self, ctx: DenoiseContext) -> bool:
+        """The reference can only share a UNet call with the main latents if both stack cleanly.
+        A reference latent of another size, regional prompts and mismatched token lengths fall back to the separate
+        reference pass."""
+        if self.once_and_only_once:
+            return False # a single extra pass gains nothing from batching, and uses a different timestep
+        if self.initial_latents.shape[-2:] != ctx.latents.shape[-2:]:
+            return False
+        token_lengths = set()
+        for conditioning in [ctx.inputs.conditioning_data, self.ref_conditioning]:
+            if conditioning.cond_regions is not None or conditioning.uncond_regions is not None:
+                return False
+            token_lengths.add(conditioning.cond_text.embeds.shape[1])
+            token_lengths.add(conditioning.uncond_text.embeds.shape[1])
+        return len(token_lengths) == 1
+
     @callback(ExtensionCallbackType.PRE_STEP)
     @torch.no_grad()
     def pre_step(self, ctx: DenoiseContext):
+        if self.stopped or not self.unet_new_processors:
+            return
+        # Once And Only Once only uses stop_at to pick the timestep of its single reference, and blends to the end
+        if not self.once_and_only_once and self.stop_at < 1 - (ctx.timestep.item() / ctx.scheduler.config.num_train_timesteps):
+            self.stop(ctx)
+            return
         if self.and_never_again:
             return
         
@@ -159,9 +312,64 @@ class RefDrop_Guidance(ExtensionBase):
         if t.dim() == 0:
             t = einops.repeat(t, "-> batch", batch=ctx.latents.size(0))
         timestep_fraction = 1 - (ctx.timestep.item() / ctx.scheduler.config.num_train_timesteps)
+        TRACE.debug("RefDrop", "step %d timestep_fraction %.3f", ctx.step_index, timestep_fraction)
+
+        cache_key = self.step_cache_key(ctx) if self.cache_reference else None
+        self.reference_model_input = None
+        self.pending_cache_key = None
+        if self.keyframe_steps:
+            self.apply_keyframes(ctx)
+        elif cache_key is not None and self.load_cached_reference(ctx, cache_key):
+            TRACE.debug("RefDrop", "using cached reference attention weights")
+        elif self.batched_reference and self.can_batch_reference(ctx):
+            self.pending_cache_key = cache_key
+            #the reference is appended to the batch of the real unet pass in append_reference_batch
+            ref_latents = ctx.scheduler.add_noise(self.initial_latents.to(ctx.latents.device), self.noise.to(ctx.latents.device), t)
+            self.reference_model_input = scale_model_input_at(ctx.scheduler, ref_latents, ctx.timestep)
+        else:
+            self.run_reference_pass(ctx, t)
+            if cache_key is not None:
+                self.store_cached_reference(cache_key)
+
+        #Change back to false, attentions will use the stored maps in the real unet pass
+        for attn_processor in self.unet_new_processors:
+            attn_processor.store_copy = False
+            if self.skip_up_block_1 and 'up_blocks.0.attentions.0' in attn_processor.attn_name and self.skip_until > timestep_fraction:
+                attn_processor.store_copy = True
+
+        ctx.timestep = t_orig
+
+        self.peak_reference_bytes = max(self.peak_reference_bytes, sum(p.reference_nbytes() for p in self.unet_new_processors))
+
+        if self.once_and_only_once:
+            self.and_never_again = True
+
+    def stop(self, ctx: DenoiseContext):
+        """Past stop_at: put the original attention processors back and drop the reference,
+        so the remaining steps run at stock speed and memory."""
+        info("RefDrop reached stop_at, restoring the original attention processors")
+        processors = ctx.unet.attn_processors
+        processors.update(self.original_processors)
+        ctx.unet.set_attn_processor(processors)
+        self.peak_reference_bytes = max(self.peak_reference_bytes, sum(p.reference_nbytes() for p in self.unet_new_processors))
+        self.release_reference(ctx)
+        self.stopped = True
+
+    def release_reference(self, ctx: DenoiseContext):
+        # the forward wrapper stays until POST_DENOISE_LOOP: unwrapping mid-loop would also strip any wrapper
+        # installed after it (tiled, dilated, ...). Once stopped it is a pass-through.
+        self.reference_model_input = None
+        self.reference_batch_size = 0
+        self.keyframe_states = {}
+        for attn_processor in self.unet_new_processors:
+            attn_processor.saved_query = None
+            attn_processor.clear_reference()
+
+    def run_reference_pass(self, ctx: DenoiseContext, t: torch.Tensor):
+        """Separate UNet call on the noised reference at ctx.timestep, leaves its keys and values in the processors."""
         self.stored_latents = ctx.latents.clone()
         ctx.latents = ctx.scheduler.add_noise(self.initial_latents.to(ctx.latents.device), self.noise.to(ctx.latents.device), t)
-        ctx.latent_model_input = ctx.scheduler.scale_model_input(ctx.latents, ctx.timestep)
+        ctx.latent_model_input = scale_model_input_at(ctx.scheduler, ctx.latents, ctx.timestep)
 
         self.stored_conditioning = ctx.inputs.conditioning_data
         ctx.inputs.conditioning_data = self.ref_conditioning
@@ -170,35 +378,159 @@ class RefDrop_Guidance(ExtensionBase):
         for attn_processor in self.unet_new_processors:
             attn_processor.store_copy = True
 
-        info(f"timestep_fraction: {timestep_fraction}")
-
-        if self.stop_at >= timestep_fraction:
-            #call the unet step to get the attention weights
-            info("Running unet to get attention weights")
-            ctx.sd_backend.run_unet(ctx, self.dummy_manager, ConditioningMode.Both)
-        else:
-            info("Skipping unet step to get attention weights")
+        #call the unet step to get the attention weights
+        TRACE.debug("RefDrop", "running reference pass at timestep %s", ctx.timestep)
+        ctx.sd_backend.run_unet(ctx, self.dummy_manager, ConditioningMode.Both)
 
-        #Change back to false, attentions will use the stored maps in the real unet pass
-        for attn_processor in self.unet_new_processors:
-            attn_processor.store_copy = False
-            if self.skip_up_block_1 and 'up_blocks.0.attentions.0' in attn_processor.attn_name and self.skip_until > timestep_fraction:
-                attn_processor.store_copy = True
-            
         ctx.latents = self.stored_latents
-        ctx.timestep = t_orig
         ctx.inputs.conditioning_data = self.stored_conditioning
 
-        if self.once_and_only_once:
-            self.and_never_again = True
+    def choose_keyframe_steps(self, timesteps: torch.Tensor, num_train_timesteps: int) -> list[int]:
+        """Steps to run the reference pass on, spread over the steps before stop_at"""
+        active = [i for i, t in enumerate(timesteps) if self.stop_at >= 1 - (t.item() / num_train_timesteps)]
+        if not active or self.keyframes <= 0:
+            return []
+        count = min(self.keyframes, len(active))
+        if count == 1:
+            return [active[0]]
+        positions = [i / (count - 1) for i in range(count)]
+        if self.keyframe_schedule == "front_loaded":
+            positions = [p ** 2 for p in positions] # denser early, where the reference changes fastest
+        return sorted({active[round(p * (len(active) - 1))] for p in positions})
+
+    def reference_states_at(self, ctx: DenoiseContext, step: int) -> dict[str, tuple]:
+        """Reference keys/values of every processor at the timestep of `step`, from the cache or a reference pass"""
+        t_orig = ctx.timestep
+        ctx.timestep = ctx.inputs.timesteps[step]
+        cache_key = self.step_cache_key(ctx) if self.cache_reference else None
+        if cache_key is None or not self.load_cached_reference(ctx, cache_key):
+            t = einops.repeat(ctx.timestep, "-> batch", batch=ctx.latents.size(0))
+            self.run_reference_pass(ctx, t)
+            if cache_key is not None:
+                self.store_cached_reference(cache_key)
+        ctx.timestep = t_orig
+        return {p.attn_name: p.reference_state() for p in self.unet_new_processors}
+
+    def apply_keyframes(self, ctx: DenoiseContext):
+        """Interpolate the reference between the keyframes on either side of this step"""
+        step = ctx.step_index
+        before = max(k for k in self.keyframe_steps if k <= step)
+        after = min((k for k in self.keyframe_steps if k >= step), default=before)
+        for k in list(self.keyframe_states):
+            if k < before:
+                del self.keyframe_states[k]
+        for k in (before, after):
+            if k not in self.keyframe_states:
+                TRACE.debug("RefDrop", "computing reference keyframe at step %d", k)
+                self.keyframe_states[k] = self.reference_states_at(ctx, k)
+
+        if before == after:
+            for attn_processor in self.unet_new_processors:
+                attn_processor.set_reference_state(self.keyframe_states[before][attn_processor.attn_name], ctx.latents.device)
+            return
+
+        # linear in the timestep value, which need not be evenly spaced over the steps
+        t_before = ctx.inputs.timesteps[before].item()
+        t_after = ctx.inputs.timesteps[after].item()
+        weight = (t_before - ctx.timestep.item()) / (t_before - t_after)
+        for attn_processor in self.unet_new_processors:
+            attn_processor.interpolate_reference(
+                self.keyframe_states[before][attn_processor.attn_name],
+                self.keyframe_states[after][attn_processor.attn_name],
+                weight,
+                ctx.latents.device,
+            )
+
+    @callback(ExtensionCallbackType.PRE_UNET, order=1000)
+    @torch.no_grad()
+    def append_reference_batch(self, ctx: DenoiseContext):
+        """Stack the noised reference onto the end of the real UNet batch.
+        Runs last so that ControlNet/T2I residuals from other extensions are already in place."""
+        if self.reference_model_input is None:
+            return
+
+        repeats = 2 if ctx.conditioning_mode == ConditioningMode.Both else 1
+        ref_kwargs = UNetKwargs(
+            sample=torch.cat([self.reference_model_input] * repeats),
+            timestep=ctx.timestep,
+            encoder_hidden_states=None,
+        )
+        self.ref_conditioning.to_unet_kwargs(ref_kwargs, ctx.conditioning_mode)
+        ref = ref_kwargs.sample.shape[0]
+
+        unet_kwargs = ctx.unet_kwargs
+        unet_kwargs.sample = torch.cat([unet_kwargs.sample, ref_kwargs.sample])
+        unet_kwargs.encoder_hidden_states = torch.cat([unet_kwargs.encoder_hidden_states, ref_kwargs.encoder_hidden_states])
+        if unet_kwargs.added_cond_kwargs is not None:
+            unet_kwargs.added_cond_kwargs = {
+                k: torch.cat([v, ref_kwargs.added_cond_kwargs[k]]) for k, v in unet_kwargs.added_cond_kwargs.items()
+            }
+
+        # the separate reference pass never sees ControlNet/T2I residuals, zero padding keeps it that way
+        def pad(residual: torch.Tensor) -> torch.Tensor:
+            return torch.cat([residual, residual.new_zeros((ref, *residual.shape[1:]))])
+
+        if unet_kwargs.down_block_additional_residuals is not None:
+            unet_kwargs.down_block_additional_residuals = tuple(pad(r) for r in unet_kwargs.down_block_additional_residuals)
+        if unet_kwargs.mid_block_additional_residual is not None:
+            unet_kwargs.mid_block_additional_residual = pad(unet_kwargs.mid_block_additional_residual)
+        if unet_kwargs.down_intrablock_additional_residuals is not None:
+            unet_kwargs.down_intrablock_additional_residuals = tuple(pad(r) for r in unet_kwargs.down_intrablock_additional_residuals)
+
+        # only a full uncond+cond reference matches what the cache holds
+        keep_reference = self.pending_cache_key is not None and ctx.conditioning_mode == ConditioningMode.Both
+        self.reference_batch_size = ref
+        for attn_processor in self.unet_new_processors:
+            attn_processor.reference_batch_size = ref
+            attn_processor.keep_reference = keep_reference
+
+    def unet_forward(self, default, **kwargs) -> torch.Tensor:
+        """Drop the reference entries from the noise prediction so the rest of the step never sees them."""
+        if self.stopped:
+            return default(**kwargs)
+        noise_pred = default(**kwargs)
+        if self.reference_batch_size > 0:
+            noise_pred = noise_pred[: -self.reference_batch_size]
+            self.reference_batch_size = 0
+            if self.pending_cache_key is not None and self.unet_new_processors[0].keep_reference:
+                self.store_cached_reference(self.pending_cache_key)
+                self.pending_cache_key = None
+            for attn_processor in self.unet_new_processors:
+                attn_processor.reference_batch_size = 0
+                if attn_processor.keep_reference:
+                    # the cache has its own copy, the batched path does not need these anymore
+                    attn_processor.clear_reference()
+                attn_processor.keep_reference = False
+        return noise_pred
     
     @callback(ExtensionCallbackType.POST_DENOISE_LOOP)
     def post_denoise_loop(self, ctx: DenoiseContext):
-        for attn_processor in self.unet_new_processors:
-            attn_processor.saved_query = None
-            attn_processor.saved_key = None
-            attn_processor.saved_value = None
+        self.report_memory(ctx)
+        self.release_reference(ctx)
+        if self.restore_unet_forward is not None:
+            self.restore_unet_forward()
+            self.restore_unet_forward = None
         torch.cuda.empty_cache()
+        TRACE.flush()
+
+    def peak_device_bytes(self) -> Optional[int]:
+        """Peak device memory during the run, or None when the run did not go above the peak from before it
+        (or did not run on CUDA)"""
+        if self.device_peak_baseline is None:
+            return None
+        peak = torch.cuda.max_memory_allocated()
+        return peak if peak > self.device_peak_baseline else None
+
+    def report_memory(self, ctx: DenoiseContext):
+        report = {
+            "storage_policy": self.storage_policy,
+            "layers": len(self.unet_new_processors),
+            "peak_reference_bytes": self.peak_reference_bytes,
+            "peak_device_bytes": self.peak_device_bytes(),
+        }
+        info(f"RefDrop reference storage: {self.peak_reference_bytes / 2**20:.1f}MB with {self.storage_policy}")
+        for hook in REFDROP_MEMORY_HOOKS:
+            hook(report)
         
 
 @invocation(
@@ -206,7 +538,7 @@ class RefDrop_Guidance(ExtensionBase):
     title="RefDrop Image Reference [Extension]",
     tags=["RefDrop", "reference", "extension"],
     category="latents",
-    version="1.0.5",
+    version="1.7.0",
 )
 class RefDrop_ExtensionInvocation(BaseInvocation):
     """Incorporates features from the reference image in the output."""
@@ -255,6 +587,63 @@ class RefDrop_ExtensionInvocation(BaseInvocation):
         description="Compute ONLY for the final step (as determined by Stop At)",
         default=False
     )
+    batched_reference: bool = InputField(
+        title="Batched Reference",
+        description="Compute the reference attention in the same UNet call as the image instead of a separate pass",
+        default=False
+    )
+    cache_reference: bool = InputField(
+        title="Cache Reference",
+        description="Reuse the reference attention across runs with the same reference latent, seed, conditioning and scheduler",
+        default=False
+    )
+    cache_budget_mb: int = InputField(
+        title="Cache Budget (MB)",
+        description="Maximum CPU memory held by the reference attention cache",
+        default=4096,
+        ge=0,
+    )
+    cache_spill_to_disk: bool = InputField(
+        title="Spill Cache To Disk",
+        description="Write evicted cache entries to a temp directory instead of dropping them",
+        default=False
+    )
+    storage_dtype: REFERENCE_STORAGE_DTYPES = InputField(
+        title="Storage Precision",
+        description="Precision of the stored reference keys/values. int8 is quantized per token.",
+        default="native",
+    )
+    token_pooling: Literal[1, 2, 4] = InputField(
+        title="Token Pooling",
+        description="Average pool the reference self-attention keys/values spatially by this factor",
+        default=1,
+    )
+    offload_to_cpu: bool = InputField(
+        title="Offload To CPU",
+        description="Hold the reference keys/values in pinned CPU memory and prefetch them per layer",
+        default=False
+    )
+    layer_selection: str = InputField(
+        title="Layer Selection",
+        description="Attention layers to apply RefDrop to. Comma separated presets (" + ", ".join(LAYER_PRESETS) + "), globs like 'up_blocks.0.*attn1', or 're:' regexes. Prefix a term with '!' to remove it.",
+        default="all",
+    )
+    single_call_blend: bool = InputField(
+        title="Single Call Blend",
+        description="Compute the image and reference attention in one attention call per layer instead of two. Uses more memory for the stacked batch.",
+        default=False
+    )
+    keyframes: int = InputField(
+        title="Keyframes",
+        description="Run the reference pass on only this many steps and interpolate between them. 0 runs it every step.",
+        default=0,
+        ge=0,
+    )
+    keyframe_schedule: Literal["uniform", "front_loaded"] = InputField(
+        title="Keyframe Schedule",
+        description="How keyframes are spread over the steps. Front loaded puts more of them early in the denoise.",
+        default="uniform",
+    )
     @torch.no_grad()
     def invoke(self, context: InvocationContext) -> GuidanceDataOutput:
         kwargs = {
@@ -265,7 +654,18 @@ class RefDrop_ExtensionInvocation(BaseInvocation):
             "positive_conditioning": self.positive_conditioning,
             "negative_conditioning": self.negative_conditioning,
             "stop_at": self.stop_at,
-            "once_and_only_once": self.once_and_only_once
+            "once_and_only_once": self.once_and_only_once,
+            "batched_reference": self.batched_reference,
+            "cache_reference": self.cache_reference,
+            "cache_budget_mb": self.cache_budget_mb,
+            "cache_spill_to_disk": self.cache_spill_to_disk,
+            "storage_dtype": self.storage_dtype,
+            "token_pooling": self.token_pooling,
+            "offload_to_cpu": self.offload_to_cpu,
+            "layer_selection": self.layer_selection,
+            "single_call_blend": self.single_call_blend,
+            "keyframes": self.keyframes,
+            "keyframe_schedule": self.keyframe_schedule,
         }
         return GuidanceDataOutput(
             guidance_data_output=GuidanceField(
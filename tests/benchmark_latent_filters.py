@@ -0,0 +1,42 @@
+"""Separable convolution against FFT for the Gaussian latent blur, over kernel sizes 3..31.
+Not collected by pytest. Run with: python tests/benchmark_latent_filters.py [--device cuda]
+
+gaussian_blur(method="auto") makes the same comparison once per kernel size and latent shape at run time; this prints
+the whole table, and the smallest kernel size from which the FFT wins for every larger one."""
+import argparse
+
+import torch
+
+from conftest import import_node_module
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256], help="latent sides (image / 8)")
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    latent_filters = import_node_module("latent_filters")
+    torch.set_grad_enabled(False)
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    generator = torch.Generator().manual_seed(0)
+    for size in args.sizes:
+        latents = torch.randn(args.batch, 4, size, size, generator=generator).to(device=device, dtype=dtype)
+        print(f"latent {args.batch}x4x{size}x{size} on {device} ({args.dtype})")
+        print(f"{'kernel':>6} {'conv ms':>8} {'fft ms':>8} {'faster':>6}")
+        faster = {}
+        for kernel_size in range(3, 32, 2):
+            sigma = kernel_size / 4
+            conv = latent_filters.time_blur(latents, kernel_size, sigma, "conv", args.repeats)
+            fft = latent_filters.time_blur(latents, kernel_size, sigma, "fft", args.repeats)
+            faster[kernel_size] = "fft" if fft < conv else "conv"
+            print(f"{kernel_size:>6} {conv * 1000:>8.3f} {fft * 1000:>8.3f} {faster[kernel_size]:>6}")
+        crossover = next((k for k in faster if all(faster[j] == "fft" for j in faster if j >= k)), None)
+        print(f"fft from kernel size: {crossover if crossover is not None else 'never (up to 31)'}\n")
+
+
+if __name__ == "__main__":
+    main()
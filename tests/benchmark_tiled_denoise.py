@@ -0,0 +1,68 @@
+"""Throughput of the tiled UNet forward against tile size and tile batch size, on a tiny UNet on the CPU.
+Not collected by pytest. Run with: python tests/benchmark_tiled_denoise.py [--height 64 --width 96]
+
+Sizes are in latent pixels (image pixels / 8). The stride is 3/4 of the tile, like the node defaults (1024/768)."""
+import argparse
+import time
+
+import torch
+
+from conftest import import_node_module, tiny_unet
+
+
+def time_forward(forward, repeats: int) -> float:
+    """Median seconds per call after one warmup call"""
+    forward()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        forward()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--width", type=int, default=96)
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[16, 24, 32, 48, 64, 96])
+    parser.add_argument("--tile-batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    multidiffusion_extensions = import_node_module("multidiffusion_extensions")
+    torch.set_grad_enabled(False)
+    unet = tiny_unet()
+    generator = torch.Generator().manual_seed(0)
+    # batch of 2: the uncond and cond halves of a CFG step
+    sample = torch.randn(2, 4, args.height, args.width, generator=generator)
+    kwargs = {
+        "timestep": torch.tensor(500),
+        "encoder_hidden_states": torch.randn(2, 77, 32, generator=generator),
+    }
+
+    def default(**unet_kwargs):
+        return unet(**unet_kwargs).sample
+
+    untiled = time_forward(lambda: default(sample=sample, **kwargs), args.repeats)
+    print(f"latent {args.height}x{args.width}, untiled: {untiled * 1000:.1f} ms")
+    print(f"{'tile':>6} {'stride':>6} {'tiles':>5} {'batch':>5} {'ms/step':>8} {'Mpx/s':>7} {'vs untiled':>10}")
+    for tile_size in args.tile_sizes:
+        stride = max(8, tile_size * 3 // 4 // 8 * 8)
+        views = multidiffusion_extensions.get_views(args.height, args.width, tile_size, stride)
+        for tile_batch_size in args.tile_batch_sizes:
+            if tile_batch_size > len(views) and tile_batch_size != args.tile_batch_sizes[0]:
+                continue
+            seconds = time_forward(
+                lambda: multidiffusion_extensions.tiled_unet_forward(default, sample, views, tile_batch_size, **kwargs),
+                args.repeats,
+            )
+            throughput = sample.shape[0] * args.height * args.width / seconds / 1e6
+            print(
+                f"{tile_size:>6} {stride:>6} {len(views):>5} {tile_batch_size:>5} {seconds * 1000:>8.1f} "
+                f"{throughput:>7.3f} {untiled / seconds:>9.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
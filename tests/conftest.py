@@ -0,0 +1,43 @@
+import importlib
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+# The node pack is a flat package that InvokeAI imports by its folder name. Register the folder under a fixed name
+# without running __init__ (which imports every node), so tests can import single modules from it.
+PACKAGE_ROOT = Path(__file__).resolve().parents[1]
+PACKAGE_NAME = "demofusion_nodes"
+
+if PACKAGE_NAME not in sys.modules:
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [str(PACKAGE_ROOT)]
+    sys.modules[PACKAGE_NAME] = package
+
+
+def import_node_module(name: str):
+    """Import a module of the node pack, skipping the test if torch or InvokeAI are not installed"""
+    pytest.importorskip("torch")
+    try:
+        return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+    except ModuleNotFoundError as e:
+        pytest.skip(f"{name} needs {e.name}")
+
+
+def tiny_unet():
+    """A two-block SD-style UNet small enough to run on the CPU, with fixed random weights"""
+    torch = pytest.importorskip("torch")
+    diffusers = pytest.importorskip("diffusers")
+    torch.manual_seed(0)
+    return diffusers.UNet2DConditionModel(
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    ).eval()
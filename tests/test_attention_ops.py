@@ -0,0 +1,52 @@
+import pytest
+
+from conftest import import_node_module
+
+torch = pytest.importorskip("torch")
+
+
+def qkv_mask(batch, heads, queries, tokens, head_dim, masked, generator):
+    query = torch.randn(batch, heads, queries, head_dim, generator=generator)
+    key = torch.randn(batch, heads, tokens, head_dim, generator=generator)
+    value = torch.randn(batch, heads, tokens, head_dim, generator=generator)
+    mask = None
+    if masked:
+        mask = torch.randn(batch, 1, queries, tokens, generator=generator)
+    return query, key, value, mask
+
+
+@pytest.mark.parametrize("masked", [False, True])
+@pytest.mark.parametrize("C", [0.0, 0.3, 1.0])
+def test_stacked_blend_matches_two_calls(masked, C):
+    attention_ops = import_node_module("attention_ops")
+    generator = torch.Generator().manual_seed(0)
+    own = qkv_mask(2, 4, 64, 77, 32, masked, generator)
+    ref = qkv_mask(2, 4, 64, 77, 32, masked, generator)
+
+    own_two, ref_two = attention_ops.paired_attention(own, ref, stacked=False)
+    own_one, ref_one = attention_ops.paired_attention(own, ref, stacked=True)
+
+    torch.testing.assert_close(own_one, own_two, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(ref_one, ref_two, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(torch.lerp(own_one, ref_one, C), torch.lerp(own_two, ref_two, C), rtol=1e-5, atol=1e-5)
+
+
+def test_stacked_blend_falls_back_for_mismatched_shapes():
+    """A pooled reference has fewer tokens than the layer's own keys, which can't share one call"""
+    attention_ops = import_node_module("attention_ops")
+    generator = torch.Generator().manual_seed(1)
+    own = qkv_mask(1, 2, 64, 64, 16, False, generator)
+    ref = qkv_mask(1, 2, 64, 16, 16, False, generator)
+
+    own_out, ref_out = attention_ops.paired_attention(own, ref, stacked=True)
+
+    torch.testing.assert_close(own_out, torch.nn.functional.scaled_dot_product_attention(*own[:3]))
+    torch.testing.assert_close(ref_out, torch.nn.functional.scaled_dot_product_attention(*ref[:3]))
+
+
+def test_int8_scale_survives_small_tokens():
+    attention_ops = import_node_module("attention_ops")
+    tensor = torch.full((1, 1, 4, 8), 1e-6)
+    quantized, scale = attention_ops.quantize_int8(tensor)
+    assert scale.dtype == torch.float32
+    torch.testing.assert_close(quantized.float() * scale, tensor, rtol=1e-2, atol=0)
@@ -0,0 +1,53 @@
+from conftest import import_node_module
+
+
+class FakeBackend:
+    def _unet_forward(self, **kwargs):
+        return ["raw"]
+
+
+def tagging_wrapper(tag):
+    def wrapper(default, **kwargs):
+        return default(**kwargs) + [tag]
+    return wrapper
+
+
+def test_wrappers_nest_in_order():
+    extension_classes = import_node_module("extension_classes")
+    backend = FakeBackend()
+    extension_classes.wrap_unet_forward(backend, tagging_wrapper("a"))
+    extension_classes.wrap_unet_forward(backend, tagging_wrapper("b"))
+    assert backend._unet_forward() == ["raw", "a", "b"]
+
+
+def test_restore_in_registration_order_leaves_the_raw_forward():
+    extension_classes = import_node_module("extension_classes")
+    backend = FakeBackend()
+    restore_a = extension_classes.wrap_unet_forward(backend, tagging_wrapper("a"))
+    restore_b = extension_classes.wrap_unet_forward(backend, tagging_wrapper("b"))
+    restore_a()
+    assert backend._unet_forward() == ["raw", "b"]
+    restore_b()
+    assert backend._unet_forward() == ["raw"]
+    assert "_unet_forward" not in vars(backend)
+
+
+def test_restore_twice_is_harmless():
+    extension_classes = import_node_module("extension_classes")
+    backend = FakeBackend()
+    restore_a = extension_classes.wrap_unet_forward(backend, tagging_wrapper("a"))
+    restore_a()
+    restore_a()
+    extension_classes.wrap_unet_forward(backend, tagging_wrapper("b"))
+    assert backend._unet_forward() == ["raw", "b"]
+
+
+def test_restore_puts_back_an_existing_instance_override():
+    extension_classes = import_node_module("extension_classes")
+    backend = FakeBackend()
+    override = lambda **kwargs: ["override"]
+    backend._unet_forward = override
+    restore_a = extension_classes.wrap_unet_forward(backend, tagging_wrapper("a"))
+    assert backend._unet_forward() == ["override", "a"]
+    restore_a()
+    assert vars(backend)["_unet_forward"] is override
@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import import_node_module
+
+torch = pytest.importorskip("torch")
+F = pytest.importorskip("torch.nn.functional")
+
+
+def reference_blur(latents, kernel_size, sigma):
+    """Plain 2D conv2d with the full k*k Gaussian"""
+    x = torch.arange(kernel_size, dtype=torch.float64) - (kernel_size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    kernel = kernel / kernel.sum()
+    kernel_2d = (kernel[:, None] * kernel[None, :]).to(latents.dtype)
+    channels = latents.shape[1]
+    weight = kernel_2d.expand(channels, 1, kernel_size, kernel_size)
+    return F.conv2d(latents, weight, padding=kernel_size // 2, groups=channels)
+
+
+@pytest.mark.parametrize("method", ["conv", "fft", "auto"])
+@pytest.mark.parametrize("kernel_size", [3, 15, 31])
+def test_blur_matches_2d_convolution(method, kernel_size):
+    latent_filters = import_node_module("latent_filters")
+    latents = torch.randn(2, 4, 24, 40, generator=torch.Generator().manual_seed(0))
+    sigma = 1.37
+    expected = reference_blur(latents, kernel_size, latent_filters.quantize_sigma(sigma))
+    blurred = latent_filters.gaussian_blur(latents, kernel_size, sigma, method)
+    assert blurred.shape == latents.shape
+    torch.testing.assert_close(blurred, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_per_step_sigmas_share_kernels():
+    latent_filters = import_node_module("latent_filters")
+    cpu = torch.device("cpu")
+    kernel = latent_filters.gaussian_kernel_1d(7, 0.5012, 4, cpu, torch.float32)
+    assert latent_filters.gaussian_kernel_1d(7, 0.4996, 4, cpu, torch.float32) is kernel
+    assert latent_filters.gaussian_kernel_1d(7, 0.52, 4, cpu, torch.float32) is not kernel
+    # the smallest DemoFusion sigma is 1e-2, never rounded down to zero
+    assert latent_filters.quantize_sigma(0.001) == latent_filters.SIGMA_STEP
+
+
+def test_auto_measures_each_shape_once():
+    latent_filters = import_node_module("latent_filters")
+    latent_filters.BLUR_METHOD_CHOICE.clear()
+    latents = torch.randn(1, 4, 16, 16)
+    for sigma in (1.0, 0.8, 0.6):
+        latent_filters.gaussian_blur(latents, 9, sigma)
+    assert list(latent_filters.BLUR_METHOD_CHOICE.values()) in (["conv"], ["fft"])
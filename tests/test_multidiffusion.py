@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import import_node_module
+
+torch = pytest.importorskip("torch")
+
+
+@pytest.mark.parametrize("height, width", [(96, 192), (192, 96), (64, 64), (128, 320)])
+def test_views_fit_latents_shorter_than_the_window(height, width):
+    multidiffusion_extensions = import_node_module("multidiffusion_extensions")
+    views = multidiffusion_extensions.get_views(height, width, window_size=128, stride=64)
+    assert len({(h1 - h0, w1 - w0) for h0, h1, w0, w1 in views}) == 1
+    h0, h1, w0, w1 = views[0]
+    assert (h1 - h0, w1 - w0) == (min(128, height), min(128, width))
+    assert all(0 <= h0 < h1 <= height and 0 <= w0 < w1 <= width for h0, h1, w0, w1 in views)
+    covered = torch.zeros(height, width, dtype=torch.bool)
+    for h0, h1, w0, w1 in views:
+        covered[h0:h1, w0:w1] = True
+    assert covered.all()
+
+
+@pytest.mark.parametrize("blend", ["gaussian", "uniform"])
+@pytest.mark.parametrize("tile_batch_size", [1, 3])
+def test_tiled_forward_on_non_square_latent_with_short_side(blend, tile_batch_size):
+    multidiffusion_extensions = import_node_module("multidiffusion_extensions")
+    generator = torch.Generator().manual_seed(0)
+    # 12 rows are fewer than the 16 pixel window, 40 columns take several tiles
+    sample = torch.randn(2, 4, 12, 40, generator=generator)
+    encoder_hidden_states = torch.randn(2, 77, 32, generator=generator)
+    views = multidiffusion_extensions.get_views(12, 40, window_size=16, stride=8)
+    calls = []
+
+    def default(sample, encoder_hidden_states, **kwargs):
+        assert encoder_hidden_states.shape[0] == sample.shape[0]
+        calls.append(sample.shape)
+        return sample * 2
+
+    noise_pred = multidiffusion_extensions.tiled_unet_forward(
+        default, sample, views, tile_batch_size, blend, encoder_hidden_states=encoder_hidden_states
+    )
+
+    torch.testing.assert_close(noise_pred, sample * 2)
+    assert all(shape[-2:] == (12, 16) for shape in calls)
+    assert len(calls) == -(-len(views) // tile_batch_size)
+
+
+def test_tile_plan_rejects_mixed_tile_sizes():
+    multidiffusion_extensions = import_node_module("multidiffusion_extensions")
+    with pytest.raises(ValueError):
+        multidiffusion_extensions.tile_plan(16, 32, [(0, 16, 0, 16), (0, 16, 16, 24)], "gaussian", torch.device("cpu"))
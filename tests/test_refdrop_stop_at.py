@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import import_node_module, tiny_unet
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("invokeai")
+
+from diffusers import DDIMScheduler, UNet2DConditionModel
+from invokeai.backend.model_patcher import ModelPatcher
+from invokeai.backend.stable_diffusion.denoise_context import DenoiseContext, DenoiseInputs
+from invokeai.backend.stable_diffusion.diffusion.conditioning_data import BasicConditioningInfo, TextConditioningData
+from invokeai.backend.stable_diffusion.diffusion.custom_atttention import CustomAttnProcessor2_0
+from invokeai.backend.stable_diffusion.diffusion_backend import StableDiffusionBackend
+from invokeai.backend.stable_diffusion.extension_callback_type import ExtensionCallbackType
+from invokeai.backend.stable_diffusion.extensions.base import ExtensionBase, callback
+from invokeai.backend.stable_diffusion.extensions_manager import ExtensionsManager
+
+STEPS = 8
+STOP_AT = 0.5
+
+
+class CountUNetCalls(ExtensionBase):
+    """UNet forwards per denoise step"""
+    def __init__(self, unet: UNet2DConditionModel):
+        self.step = -1
+        self.calls: dict[int, int] = {}
+        unet.register_forward_pre_hook(self.count)
+        super().__init__()
+
+    def count(self, module, args):
+        self.calls[self.step] = self.calls.get(self.step, 0) + 1
+
+    @callback(ExtensionCallbackType.PRE_STEP, order=-1000)
+    def pre_step(self, ctx: DenoiseContext):
+        self.step = ctx.step_index
+
+
+def run_refdrop(batched_reference: bool):
+    refDrop_extensions = import_node_module("refDrop_extensions")
+    refDrop_attention = import_node_module("refDrop_attention")
+
+    unet = tiny_unet()
+    scheduler = DDIMScheduler(num_train_timesteps=1000)
+    scheduler.set_timesteps(STEPS)
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.zeros(1, 4, 8, 8)
+    noise = torch.randn(1, 4, 8, 8, generator=generator)
+    reference = torch.randn(1, 4, 8, 8, generator=generator)
+    conditioning = TextConditioningData(
+        uncond_text=BasicConditioningInfo(embeds=torch.randn(1, 77, 32, generator=generator)),
+        cond_text=BasicConditioningInfo(embeds=torch.randn(1, 77, 32, generator=generator)),
+        uncond_regions=None,
+        cond_regions=None,
+        guidance_scale=7.5,
+    )
+    ctx = DenoiseContext(
+        inputs=DenoiseInputs(
+            orig_latents=latents,
+            timesteps=scheduler.timesteps,
+            init_timestep=scheduler.timesteps[:1],
+            noise=noise,
+            seed=0,
+            scheduler_step_kwargs={},
+            conditioning_data=conditioning,
+            attention_processor_cls=CustomAttnProcessor2_0,
+        ),
+        unet=unet,
+        scheduler=scheduler,
+    )
+    sd_backend = StableDiffusionBackend(unet, scheduler)
+    ctx.sd_backend = sd_backend
+
+    context = SimpleNamespace(tensors=SimpleNamespace(load=lambda name: reference))
+    refdrop = refDrop_extensions.RefDrop_Guidance(
+        context=context,
+        C=0.3,
+        latent_image_name=f"reference-{batched_reference}",
+        skip_up_block_1=False,
+        skip_until=0.0,
+        positive_conditioning=None,
+        negative_conditioning=None,
+        stop_at=STOP_AT,
+        once_and_only_once=False,
+        batched_reference=batched_reference,
+    )
+    counter = CountUNetCalls(unet)
+    ext_manager = ExtensionsManager()
+    ext_manager.add_extension(counter)
+    ext_manager.add_extension(refdrop)
+
+    # state right after stop_at, before the next step's UNet call
+    after_stop = {}
+
+    class InspectAfterStop(ExtensionBase):
+        @callback(ExtensionCallbackType.PRE_UNET)
+        def pre_unet(self, ctx: DenoiseContext):
+            if refdrop.stopped and not after_stop:
+                after_stop["processors"] = list(ctx.unet.attn_processors.values())
+                after_stop["references"] = [
+                    (p.saved_key, p.saved_value, p.saved_scales) for p in refdrop.unet_new_processors
+                ]
+                after_stop["reference_model_input"] = refdrop.reference_model_input
+
+    ext_manager.add_extension(InspectAfterStop())
+
+    with torch.no_grad(), ModelPatcher.patch_unet_attention_processor(unet, CustomAttnProcessor2_0):
+        sd_backend.latents_from_embeddings(ctx, ext_manager)
+
+    stop_step = next(
+        i for i, t in enumerate(scheduler.timesteps) if STOP_AT < 1 - t.item() / scheduler.config.num_train_timesteps
+    )
+    return counter.calls, stop_step, after_stop, refDrop_attention.StoreAttentionModulation, sd_backend
+
+
+@pytest.mark.parametrize("batched_reference", [False, True])
+def test_steps_after_stop_at_make_one_unet_call(batched_reference):
+    calls, stop_step, _, _, _ = run_refdrop(batched_reference)
+    assert 0 < stop_step < STEPS
+    before = [calls[i] for i in range(stop_step)]
+    after = [calls[i] for i in range(stop_step, STEPS)]
+    assert before == [1 if batched_reference else 2] * stop_step
+    assert after == [1] * (STEPS - stop_step)
+
+
+@pytest.mark.parametrize("batched_reference", [False, True])
+def test_stop_at_frees_the_reference_and_processors(batched_reference):
+    _, _, after_stop, store_cls, sd_backend = run_refdrop(batched_reference)
+    assert after_stop, "stop_at was never reached"
+    assert not any(isinstance(p, store_cls) for p in after_stop["processors"])
+    assert all(tensor is None for state in after_stop["references"] for tensor in state)
+    assert after_stop["reference_model_input"] is None
+    # the batched forward wrapper is removed after the loop, not at stop_at
+    assert "_unet_forward" not in vars(sd_backend)